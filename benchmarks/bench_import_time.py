@@ -0,0 +1,65 @@
+"""bench_import_time
+
+Benchmark the time it takes to import nsdcode in a fresh interpreter, as
+every worker of a process pool or cluster array job does, and check that
+the heavy dependencies (nibabel, scipy, tqdm, PIL, pandas) are only
+imported when they are first used.
+
+usage:
+    python benchmarks/bench_import_time.py
+        [--repeat 10] [--module nsdcode nsdcode.meadows.meadows]
+
+The script exits with an error if one of the modules pulls in a heavy
+dependency at import time.
+"""
+import argparse
+import subprocess
+import sys
+import numpy as np
+
+HEAVY = ('nibabel', 'scipy', 'tqdm', 'PIL', 'pandas')
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(sorted(
+    name for name in {heavy} if name in sys.modules)))
+"""
+
+
+def bench(module, repeat):
+    """median import time of <module> and the heavy modules it imported"""
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)],
+            check=True, capture_output=True, text=True).stdout.split('\n')
+        timings.append(float(output[0]))
+
+    return np.median(timings), output[1].split()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument(
+        '--module', nargs='+',
+        default=['nsdcode', 'nsdcode.meadows.meadows'])
+    args = parser.parse_args()
+
+    # numpy is needed by everything, so it is the floor
+    t_numpy, _ = bench('numpy', args.repeat)
+    print(f'{"numpy":<24} {t_numpy*1000:8.1f} ms')
+
+    failed = False
+    for module in args.module:
+        t_module, heavy = bench(module, args.repeat)
+        print(f'{module:<24} {t_module*1000:8.1f} ms'
+              f' (+{(t_module - t_numpy)*1000:.1f} ms over numpy)')
+        if heavy:
+            print(f'  imports {", ".join(heavy)} eagerly')
+            failed = True
+
+    sys.exit(failed)
@@ -0,0 +1,90 @@
+"""bench_interp_order
+
+Benchmark the z-order (morton) sorting of target coordinates in
+interp_prepare against interpolating in the order of the target grid.
+
+The transforms are synthetic oblique (rotated and rescaled) mappings between
+grids the size of the NSD spaces, so no data needs to be downloaded:
+
+    func1pt0 <- anat0pt5 : 145 x 186 x 145 targets, 512^3 source
+    anat0pt5 <- func1pt0 : 512^3 targets, 145 x 186 x 145 source
+
+usage:
+    python benchmarks/bench_interp_order.py [--scale 0.5] [--repeat 3]
+                                            [--interptype linear cubicconv]
+
+<scale> shrinks the anat0pt5 grids (e.g. 0.5 for 256^3) on machines with
+less than ~32GB of memory ('cubicconv' needs several more GB for its
+weights).
+"""
+import argparse
+import time
+import numpy as np
+from nsdcode.interp_wrapper import interp_prepare, interp_wrapper
+
+
+def oblique_coords(targetshape, sourceshape, angles=(25, 35, 15)):
+    """3 x N source coordinates of a rotated target grid (fortran order)"""
+    grid = np.stack(np.meshgrid(
+        *[np.linspace(-0.5, 0.5, n) for n in targetshape],
+        indexing='ij'), axis=0).reshape(3, -1, order='F')
+
+    rot = np.eye(3)
+    for axis, angle in enumerate(np.deg2rad(angles)):
+        c_rot = np.eye(3)
+        i, j = [k for k in range(3) if k != axis]
+        c_rot[[i, i, j, j], [i, j, i, j]] = [
+            np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)]
+        rot = c_rot @ rot
+
+    sourceshape = np.asarray(sourceshape, dtype=np.float64)[:, np.newaxis]
+    return (rot @ grid)*sourceshape*0.8 + sourceshape/2
+
+
+def bench(name, targetshape, sourceshape, interptypes, repeat):
+    rng = np.random.default_rng(0)
+    vol = rng.random(sourceshape)
+    coords = oblique_coords(targetshape, sourceshape)
+
+    print(f'{name}: {np.prod(targetshape)} targets, source {sourceshape}')
+    for interptype in interptypes:
+        timings = {}
+        results = {}
+        for sort in (False, True):
+            start = time.perf_counter()
+            plan = interp_prepare(
+                coords, sourceshape, interptype=interptype, sort=sort)
+            t_plan = time.perf_counter() - start
+
+            t_vol = np.inf
+            for _ in range(repeat):
+                start = time.perf_counter()
+                results[sort] = interp_wrapper(
+                    vol, None, interptype=interptype, plan=plan)
+                t_vol = min(t_vol, time.perf_counter() - start)
+            timings[sort] = (t_plan, t_vol)
+
+        same = np.array_equal(results[False], results[True], equal_nan=True)
+        print(
+            f'  {interptype:9s} plan {timings[False][0]:6.2f}s -> '
+            f'{timings[True][0]:6.2f}s (sorted), per volume '
+            f'{timings[False][1]:6.2f}s -> {timings[True][1]:6.2f}s '
+            f'(x{timings[False][1]/timings[True][1]:.2f}), '
+            f'identical: {same}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--interptype', nargs='+', default=['linear', 'cubic'])
+    args = parser.parse_args()
+
+    func1pt0 = (145, 186, 145)
+    anat0pt5 = (int(round(512*args.scale)),)*3
+
+    bench('func1pt0 <- anat0pt5', func1pt0, anat0pt5,
+          args.interptype, args.repeat)
+    bench('anat0pt5 <- func1pt0', anat0pt5, func1pt0,
+          args.interptype, args.repeat)
@@ -1,3 +1,4 @@
 
 from .version import version as __version__  # noqa
-from .nsd_mapdata import *  #noqa
\ No newline at end of file
+from .nsd_mapdata import *  #noqa
+from .nsd_scheduler import *  #noqa
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""compose_transforms
+"""
+import numpy as np
+from nsdcode.interp_wrapper import interp_prepare, interp_wrapper as iw
+
+__all__ = ["compose_transforms"]
+
+
+def _pullback(field, locs):
+    """express locations given in the target of <field> in its source
+
+    Args:
+        field (nd-array): X x Y x Z x 3 case-1 transform (1-based
+                          decimal coordinates into its source space,
+                          9999 for invalid locations).
+        locs (nd-array): ... x 3 locations (1-based decimal coordinates,
+                         9999 for invalid locations) in the target space
+                         of <field>.
+
+    Returns:
+        [nd-array]: ... x 3 locations in the source space of <field>,
+                    with 9999 for invalid locations.
+    """
+    shape = locs.shape
+
+    # construct coordinates
+    coords = np.array(locs.reshape([-1, 3], order='F').T, dtype=np.float64)
+
+    # ensure that 9999 locations will propagate as NaN
+    coords[coords == 9999] = np.nan
+    coords = coords - 1  # coords is based on Kendrick's 1-based indexing.
+
+    plan = interp_prepare(coords, field.shape, copy=False)
+
+    # a location that draws on a hole of the field is a hole too
+    holes = np.any(field == 9999, axis=3).astype(np.float64)
+    bad = iw(holes, None, interptype='linear', plan=plan) != 0
+
+    # linearly interpolate each component of the field
+    composite = np.empty((coords.shape[1], 3))
+    for dim in range(3):
+        composite[:, dim] = iw(
+            field[:, :, :, dim], None, interptype='linear', plan=plan)
+    bad |= np.any(np.isnan(composite), axis=1)
+    composite[bad, :] = 9999
+
+    return composite.reshape(shape, order='F')
+
+
+def compose_transforms(transforms):
+    """chain several transforms into a single one
+
+    Args:
+        transforms (list): (casenum, a1_data) for each hop of a route,
+                    ordered from the source space to the target space,
+                    with casenum and a1_data as returned by parse_case
+                    and load_transform. Supported hops are volume-to-volume
+                    (case 1), volume-to-nativesurface (case 2) and
+                    nativesurface-to-fsaverage or fsaverage-to-nativesurface
+                    (case 3).
+
+    Raises:
+        ValueError: if a hop cannot be chained onto the next one (e.g.
+                    anything after a surface-to-volume hop).
+
+    Returns:
+        casenum (int): the case of the composite transform.
+        a1_data (nd-array): the composite transform, in the same format as
+                    load_transform returns for <casenum>, so that it can be
+                    handed to transform_data like a single transform.
+
+    We start from the last hop and pull its locations back through the
+    earlier hops. Index tables (case 3) are composed exactly, by gathering
+    the rows of the previous hop. Coordinates that land in the target of
+    a volume-to-volume hop are mapped through that hop by linear
+    interpolation of its coordinate field; locations that touch an
+    invalid (9999) location of the field become invalid too.
+
+    For example, func1pt8 -> lh.white -> fsaverage composes into a case-2
+    transform that holds, for each fsaverage vertex, its func1pt8
+    coordinates, so the data are interpolated only once.
+    """
+    casenum, a1_data = transforms[-1]
+
+    for prevcase, prevdata in reversed(transforms[:-1]):
+        if casenum == 3 and prevcase in (2, 3):
+            # matlab based indexing in a1_data: 0-based in python
+            a1_data = prevdata[np.squeeze(a1_data.astype(int), axis=1) - 1, :]
+            casenum = prevcase
+        elif casenum in (1, 2) and prevcase == 1:
+            a1_data = _pullback(prevdata, a1_data)
+        else:
+            raise ValueError(
+                f'cannot compose a case {prevcase} transform '
+                f'with a case {casenum} transform.')
+
+    return casenum, a1_data
@@ -0,0 +1,245 @@
+"""interp_pool
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+from nsdcode.interp_wrapper import interp_wrapper
+
+__all__ = ["share_array", "attach_array", "interp_volumes_pool"]
+
+
+# arrays attached by a pool worker, kept alive for the lifetime of the worker
+_worker = {}
+
+
+def share_array(arr, order='F', chunk_bytes=2**28):
+    """copy an array into a new block of shared memory
+
+    Args:
+        arr (nd-array or array proxy): the array to share. An array proxy
+                               (e.g. the dataobj of a nibabel image) is
+                               read from disk straight into the shared
+                               block, a few volumes (last axis) at a time
+                               and in double format like get_fdata, so the
+                               data are never held in memory twice.
+        order (str, optional): memory layout of the shared copy.
+                               Defaults to 'F'.
+        chunk_bytes (int, optional): how much of an array proxy to read at
+                               a time. Defaults to 256 MB.
+
+    Returns:
+        shm (SharedMemory): the shared block. The caller owns it and must
+                            close() and unlink() it when done.
+        spec (tuple): (name, shape, dtype, order), everything that
+                      attach_array needs to find the array again.
+    """
+    if isinstance(arr, np.ndarray) or not hasattr(arr, 'shape'):
+        arr = np.asarray(arr)
+        shape, dtype = arr.shape, arr.dtype
+    else:
+        shape, dtype = tuple(arr.shape), np.dtype(np.float64)
+
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, order=order)
+    if isinstance(arr, np.ndarray):
+        view[...] = arr
+    else:
+        step = max(1, chunk_bytes // max(nbytes // max(shape[-1], 1), 1))
+        for start in range(0, shape[-1], step):
+            view[..., start:start + step] = arr[..., start:start + step]
+    del view
+
+    return shm, (shm.name, shape, dtype.str, order)
+
+
+def attach_array(spec, readonly=True):
+    """attach to an array created by share_array without copying it
+
+    Args:
+        spec (tuple): the spec returned by share_array.
+        readonly (bool, optional): whether to return a read-only view.
+                                   Defaults to True.
+
+    Returns:
+        shm (SharedMemory): the attached block (keep a reference to it for
+                            as long as the view is in use).
+        view (nd-array): the array, backed by the shared block.
+    """
+    name, shape, dtype, order = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no <track> argument
+        shm = shared_memory.SharedMemory(name=name)
+    view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, order=order)
+    if readonly:
+        view.flags.writeable = False
+
+    return shm, view
+
+
+def _file_spec(arr):
+    """(filename, offset, shape, dtype) of a memory-mapped array, or None
+
+    Only fortran-ordered np.memmap arrays (or views that start anywhere in
+    them, e.g. a reshaped sink) qualify, since a worker maps them again
+    from the file.
+    """
+    if not isinstance(arr, np.memmap) or arr.filename is None or \
+            not arr.flags.f_contiguous:
+        return None
+
+    # (the offset of a view is that of the array that mapped the file)
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    offset = arr.offset + arr.ctypes.data - root.ctypes.data
+
+    return (arr.filename, offset, arr.shape, arr.dtype.str)
+
+
+def _init_worker(specs, volshape, interptype, badval, outfile=None):
+    """attach the shared plan, output (and source) in a pool worker"""
+    for key, spec in specs.items():
+        _worker[key] = attach_array(spec, readonly=key != 'out')
+    if outfile is not None:
+        filename, offset, shape, dtype = outfile
+        _worker['out'] = (None, np.memmap(
+            filename, dtype=dtype, mode='r+', offset=offset, shape=shape,
+            order='F'))
+    _worker['plan'] = {
+        'coords': _worker['coords'][1],
+        'bad': _worker['bad'][1],
+        'volshape': volshape,
+        'order': _worker['order'][1] if 'order' in _worker else None}
+    if 'cubicconv_index' in _worker:
+        _worker['plan']['cubicconv'] = (
+            _worker['cubicconv_index'][1], _worker['cubicconv_frac'][1])
+    _worker['interptype'] = interptype
+    _worker['badval'] = badval
+
+
+def _map_volume(vol_i, vol=None):
+    """interpolate one volume and write it into the shared output"""
+    if vol is None:
+        vol = _worker['source'][1][..., vol_i]
+
+    tmp = interp_wrapper(
+        vol,
+        None,
+        interptype=_worker['interptype'],
+        plan=_worker['plan'])
+    tmp[np.isnan(tmp)] = _worker['badval']
+    _worker['out'][1][:, vol_i] = tmp
+
+    return vol_i
+
+
+def interp_volumes_pool(sourcedata, plan, interptype, outputclass, badval,
+                        n_jobs=None, share_source=True, out=None):
+    """interpolate every volume of a 4D stack in a pool of processes
+
+    The coordinates, bad mask and sort order of <plan> (the cubic-convolution
+    taps and offsets too, if present, and optionally <sourcedata>)
+    are placed in shared memory once, and the workers attach to them
+    read-only, so the transform is never copied to each worker. Every
+    worker writes its volumes straight into a shared output matrix, or into
+    <out> if that is a memory-mapped file (e.g. a sink), which the workers
+    map themselves.
+
+    Args:
+        sourcedata (nd-array): X x Y x Z x D source volumes. This can be
+                                a nibabel array proxy, which is read
+                                straight into shared memory (see
+                                share_array).
+        plan (dict): output of interp_prepare for the target coordinates.
+        interptype (str): see interp_wrapper.
+        outputclass (dtype): the output format to use.
+        badval (float): the value to use for invalid locations.
+        n_jobs (int, optional): number of worker processes. None or -1
+                                means to use all cpus. Defaults to None.
+        share_source (bool, optional): whether to place <sourcedata> in
+                                shared memory too. If False, each volume is
+                                sent to its worker with the task.
+                                Defaults to True.
+        out (nd-array, optional): N x D array to write the results into.
+                                Defaults to None.
+
+    Returns:
+        transformeddata (nd-array): N x D data in <outputclass> (<out>, if
+                                given).
+    """
+    from tqdm import tqdm
+
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    n_points = plan['bad'].size
+    n_vols = sourcedata.shape[-1]
+
+    arrays = [('coords', plan['coords']), ('bad', plan['bad'])]
+    if plan.get('order') is not None:
+        arrays.append(('order', plan['order']))
+    if 'cubicconv' in plan:
+        arrays.append(('cubicconv_index', plan['cubicconv'][0]))
+        arrays.append(('cubicconv_frac', plan['cubicconv'][1]))
+    if share_source:
+        arrays.append(('source', sourcedata))
+
+    blocks = {}
+    specs = {}
+    try:
+        for key, arr in arrays:
+            blocks[key], specs[key] = share_array(arr)
+
+        # the output is written straight into a memory-mapped <out>, or
+        # allocated directly in shared memory
+        outshape = (n_points, n_vols)
+        outclass = np.dtype(outputclass)
+        outfile = _file_spec(out)
+        if outfile is None:
+            blocks['out'] = shared_memory.SharedMemory(
+                create=True, size=max(n_points*n_vols*outclass.itemsize, 1))
+            specs['out'] = (blocks['out'].name, outshape, outclass.str, 'F')
+
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                initializer=_init_worker,
+                initargs=(specs, plan['volshape'], interptype, badval,
+                          outfile)
+                ) as pool:
+            if share_source:
+                futures = [
+                    pool.submit(_map_volume, vol_i)
+                    for vol_i in range(n_vols)]
+            else:
+                futures = [
+                    pool.submit(_map_volume, vol_i, sourcedata[..., vol_i])
+                    for vol_i in range(n_vols)]
+
+            for future in tqdm(
+                    as_completed(futures), total=n_vols, desc='volumes'):
+                future.result()
+
+        # copy the result out of shared memory before releasing it
+        if outfile is not None:
+            transformeddata = out
+        else:
+            shared = np.ndarray(
+                outshape, dtype=outclass, buffer=blocks['out'].buf,
+                order='F')
+            if out is None:
+                transformeddata = np.array(shared, order='F')
+            else:
+                out[...] = shared
+                transformeddata = out
+            del shared
+
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+
+    return transformeddata
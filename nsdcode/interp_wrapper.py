@@ -1,21 +1,281 @@
 """interp_wrapper
 """
 import numpy as np
-from scipy.ndimage import map_coordinates
 from nsdcode.utils import isnotfinite
 
-__all__ = ["interp_wrapper"]
+__all__ = ["interp_prepare", "interp_wrapper"]
 
 
-def interp_wrapper(vol, coords, interptype='cubic'):
+def interp_prepare(coords, volshape, copy=True, interptype=None, sort=None):
     """
-     interp_wrapper(vol, coords, interptype)
+     interp_prepare(coords, volshape, copy, interptype, sort)
 
-     <vol> is a 3D matrix (can be complex-valued)
      <coords> is 3 x N with the matrix coordinates to interpolate at.
        one or more of the entries can be NaN.
-     <interptype> (optional) is 'nearest' | 'linear' | 'cubic' | 'wta'.  
-        default: 'cubic'.
+     <volshape> is the shape of the volume(s) that will be interpolated
+       (only the first three dimensions are used).
+     <copy> (optional) is whether to work on a copy of <coords>. set this
+       to False only if <coords> is a scratch array owned by the caller.
+       default: True.
+     <interptype> (optional) is the interpolation type the plan will be
+       used with. for 'cubicconv', the cubic-convolution taps and weights
+       are precomputed too. default: None.
+     <sort> (optional) is whether to visit the coordinates in the
+       z-order (morton) of the source voxels they fall in, rather than in
+       the order given. neighbouring samples then read neighbouring
+       voxels, which makes much better use of the cpu cache when the
+       source is large and the transform is oblique. the results are
+       scattered back, so this does not change them. default: None,
+       which means to sort for sources of more than 256 x 256 x 256 voxels
+       (e.g. anat0pt8 and anat0pt5), where the gain per volume outweighs
+       the cost of sorting.
+
+     return a plan (dict) with the fields:
+       'coords' - 3 x N float64 coordinates where non-finite entries have
+                  been replaced by 1 so that they can be safely handed
+                  to map_coordinates (in the sorted order, if sorted).
+       'bad'    - N boolean vector marking coordinates that are non-finite
+                  or outside of the original field-of-view.
+       'volshape' - the first three dimensions of <volshape>.
+       'order'  - N vector with, for each entry of 'coords', its index in
+                  the original order (or None if not sorted).
+       'cubicconv' - only if <interptype> is 'cubicconv': the output of
+                  _cubicconv_prepare.
+
+     the plan only depends on the coordinates and the volume size, so it
+     can be computed once and reused for every volume of a 4D stack.
+     interp_wrapper never writes into the arrays of a plan, which means
+     that they can be shared read-only (e.g. across processes).
+
+    """
+    if copy:
+        coords = np.array(coords, dtype=np.float64)
+    else:
+        coords = np.asarray(coords, dtype=np.float64)
+    volshape = tuple(volshape[:3])
+
+    # bad locations must get set to NaN
+    bad = np.any(isnotfinite(coords), axis=0)
+    coords[:, bad] = 1
+
+    # out of range must become NaN, too
+    for dim in range(3):
+        bad |= coords[dim, :] < 1
+        bad |= coords[dim, :] > volshape[dim]
+
+    # visit the source in z-order
+    if sort is None:
+        sort = np.prod(volshape) > 2**24
+    order = None
+    if sort:
+        order = np.argsort(_morton_code(coords))
+        coords = coords[:, order]
+
+    plan = {
+        'coords': coords,
+        'bad': bad,
+        'volshape': volshape,
+        'order': order}
+    if interptype == 'cubicconv':
+        plan['cubicconv'] = _cubicconv_prepare(coords, volshape)
+
+    return plan
+
+
+def _spread_bits(vals):
+    """
+     _spread_bits(vals)
+
+     return the uint64 <vals> (21 bits used) with two zero bits inserted
+     after each bit, i.e. bit b moves to bit 3*b.
+
+    """
+    vals = vals & np.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff),
+                        (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f),
+                        (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)):
+        vals = (vals | (vals << np.uint64(shift))) & np.uint64(mask)
+
+    return vals
+
+
+def _morton_code(coords):
+    """
+     _morton_code(coords)
+
+     <coords> is 3 x N (finite) matrix coordinates.
+
+     return the N vector of z-order (morton) codes of the voxels that the
+     coordinates fall in, interleaving the bits of the x, y and z indices.
+
+    """
+    code = np.zeros(coords.shape[1], dtype=np.uint64)
+    for dim in range(3):
+        voxels = np.clip(np.floor(coords[dim, :]), 0, 2**21 - 1)
+        code |= _spread_bits(voxels.astype(np.uint64)) << np.uint64(dim)
+
+    return code
+
+
+# padding of the volume for cubic convolution (the taps reach 2 voxels out,
+# and coordinates up to the size of the volume are valid)
+_CC_PAD = 3
+
+
+def _cubicconv_kernel(dist, a=-0.5):
+    """
+     _cubicconv_kernel(dist, a)
+
+     the cubic-convolution kernel of keys (1981) at the absolute distances
+     <dist> (0 to 2). a=-0.5 is the variant used by ba_interp3 (and by
+     matlab's interp3/imresize 'cubic').
+
+    """
+    near = (a + 2)*dist**3 - (a + 3)*dist**2 + 1
+    far = a*dist**3 - 5*a*dist**2 + 8*a*dist - 4*a
+
+    return np.where(dist <= 1, near, far)
+
+
+def _cubicconv_prepare(coords, volshape):
+    """
+     _cubicconv_prepare(coords, volshape)
+
+     <coords> is 3 x N, as in the plan of interp_prepare (finite).
+     <volshape> is the shape of the volume(s) that will be interpolated.
+
+     return <index>, <frac> where <index> is the N vector of the first
+     of the 4 x 4 x 4 taps of each location, as a flat (fortran order)
+     index into the volume padded by _CC_PAD voxels on each side, and
+     <frac> is 3 x N float32 with the offset of each location from its
+     second tap along each dimension. they only depend on the
+     coordinates, so they are computed once and reused for every volume.
+     the kernel weights of the taps are formed from <frac> one block of
+     locations at a time (see _cubicconv), which keeps the plan at 12
+     bytes per location instead of 96 for 3 x N x 4 float64 weights.
+
+    """
+    padshape = np.asarray(volshape[:3]) + 2*_CC_PAD
+    strides = np.array([1, padshape[0], padshape[0]*padshape[1]])
+
+    index = np.zeros(coords.shape[1], dtype=np.intp)
+    frac = np.empty((3, coords.shape[1]), dtype=np.float32)
+    for dim in range(3):
+        # locations outside of the volume are bad anyway, so we only
+        # need to keep their taps inside of the padded volume
+        c_coords = np.clip(coords[dim, :], 0, volshape[dim])
+        base = np.floor(c_coords)
+        frac[dim, :] = c_coords - base
+
+        # the taps are at base-1, base, base+1 and base+2
+        index += (base.astype(np.intp) - 1 + _CC_PAD)*strides[dim]
+
+    return index, frac
+
+
+def _cubicconv(vol, cubicconv):
+    """
+     _cubicconv(vol, cubicconv)
+
+     <vol> is a real-valued X x Y x Z or X x Y x Z x D matrix.
+     <cubicconv> is the output of _cubicconv_prepare for the shape of <vol>.
+
+     return <vol> interpolated by cubic convolution (with the edge voxels
+     replicated outside of the volume, like mode='nearest'), N for a 3D
+     <vol> or N x D for a stack. for a stack, each tap gathers the values
+     of all D volumes at once, and the tap weights are formed once for the
+     whole stack.
+
+    """
+    index, frac = cubicconv
+    is3d = vol.ndim == 3
+    if is3d:
+        vol = vol[..., np.newaxis]
+    n_vols = vol.shape[3]
+
+    # padded volumes as rows of (fortran order) voxels x volumes
+    padded = np.pad(
+        np.nan_to_num(vol).astype(np.float64, copy=False),
+        [(_CC_PAD, _CC_PAD)]*3 + [(0, 0)],
+        mode='edge')
+    padshape = padded.shape[:3]
+    rows = np.ascontiguousarray(padded.transpose(2, 1, 0, 3)).reshape(
+        -1, n_vols)
+    del padded
+
+    # flat offsets of the 4 x 4 x 4 taps (in the order of the weights)
+    taps = np.arange(4)
+    offsets = (
+        taps[:, np.newaxis, np.newaxis]
+        + taps[np.newaxis, :, np.newaxis]*padshape[0]
+        + taps[np.newaxis, np.newaxis, :]*padshape[0]*padshape[1]).ravel()
+
+    # process the locations in blocks of a few MB
+    blocksize = max(256, 8192 // n_vols)
+    n_points = index.size
+    transformeddata = np.empty((n_points, n_vols))
+    for start in range(0, n_points, blocksize):
+        block = slice(start, start + blocksize)
+        # (3 x block x 4 kernel weights, in float64)
+        weights = _cubicconv_kernel(
+            np.abs(frac[:, block, np.newaxis] + (1. - taps)))
+        wts = (
+            weights[0, :, :, np.newaxis, np.newaxis]
+            * weights[1, :, np.newaxis, :, np.newaxis]
+            * weights[2, :, np.newaxis, np.newaxis, :]).reshape(-1, 64)
+        vals = rows[index[block, np.newaxis] + offsets]
+        np.einsum('ij,ijk->ik', wts, vals, out=transformeddata[block])
+
+    if is3d:
+        transformeddata = transformeddata[:, 0]
+
+    return transformeddata
+
+
+def _spline_prefilter(vols, order):
+    """
+     _spline_prefilter(vols, order)
+
+     <vols> is P x X x Y x Z, a stack of P real-valued volumes.
+     <order> is the spline order (2 to 5).
+
+     return <filtered>, <npad> where <filtered> holds the spline
+     coefficients of each volume, padded by <npad> voxels on each side of
+     every spatial dimension. this is exactly what map_coordinates computes
+     internally for mode='nearest', except that all P volumes are filtered
+     in one pass along each axis. interpolate with
+     map_coordinates(filtered[p], coords + npad, prefilter=False, ...).
+
+    """
+    from scipy.ndimage import spline_filter1d
+
+    npad = 12
+    filtered = np.pad(
+        vols, [(0, 0)] + [(npad, npad)]*3, mode='edge').astype(
+            np.float64, copy=False)
+    for axis in (1, 2, 3):
+        spline_filter1d(
+            filtered, order, axis=axis, output=filtered, mode='nearest')
+
+    return filtered, npad
+
+
+def interp_wrapper(vol, coords, interptype='cubic', plan=None):
+    """
+     interp_wrapper(vol, coords, interptype, plan)
+
+     <vol> is a 3D matrix (can be complex-valued). for 'cubicconv', it can
+       also be X x Y x Z x D, which interpolates all D volumes in one pass
+       and returns N x D.
+     <coords> is 3 x N with the matrix coordinates to interpolate at.
+       one or more of the entries can be NaN.
+     <interptype> (optional) is 'nearest' | 'linear' | 'cubic' | 'cubicconv'
+        | 'wta'. default: 'cubic'.
+     <plan> (optional) is the output of interp_prepare for <coords> and
+        the size of <vol>. when supplied, <coords> is ignored (it can be
+        None) and the plan is used read-only. default: None.
 
      this is a convenient wrapper for ba_interp3.  the main problem with
      normal calls to ba_interp3 is that it assigns values to interpolation
@@ -26,19 +286,28 @@ def interp_wrapper(vol, coords, interptype='cubic'):
      are returned as NaN and coordinates that have any NaNs are returned
      as NaN.
 
+     'cubic' is a cubic b-spline, which needs a prefilter pass over every
+     volume. 'cubicconv' is the local 4 x 4 x 4 cubic-convolution kernel
+     (keys, a=-0.5), as in ba_interp3: it needs no prefilter, and its taps
+     and weights are computed once per plan (see interp_prepare), which
+     makes it cheaper for 4D stacks and closer to the matlab results.
+
      another feature is 'wta' (winner-take-all). this involves the assumption
      that <vol> contains only discrete integers. each distinct integer is
      mapped as a binary volume (0s and 1s) using linear interpolation to each
      coordinate, the integer with the largest resulting value at that
      coordinate wins, and that coordinate is assigned the winning integer.
 
-     for complex-valued data, we separately interpolate the real and imaginary
-     parts.
+     for complex-valued data (decided from the dtype of <vol>), we separately
+     interpolate the real and imaginary parts. the two parts are stacked and
+     spline-prefiltered together, and share the same coordinates.
 
      history:
      2019/09/01 - ported to python by ian charest
 
     """
+    from scipy.ndimage import map_coordinates
+
     # input
     if interptype == 'cubic':
         order = 3
@@ -48,39 +317,56 @@ def interp_wrapper(vol, coords, interptype='cubic'):
         order = 0
     elif interptype == 'wta':
         order = 1  # linear
+    elif interptype == 'cubicconv':
+        order = None  # no spline
     else:
         raise ValueError('interpolation method not implemented.')
 
     # convert vol to float (needed)
     # vol = vol.astype(np.float32)
 
-    # bad locations must get set to NaN
-    bad = np.any(isnotfinite(coords), axis=0)
-    coords[:, bad] = 1
-
-    # out of range must become NaN, too
-    bad = np.any(
-        np.c_[
-            bad,
-            coords[0, :] < 1,
-            coords[0, :] > vol.shape[0],
-            coords[1, :] < 1,
-            coords[1, :] > vol.shape[1],
-            coords[2, :] < 1,
-            coords[2, :] > vol.shape[2]], axis=1).astype(bool)
+    # clean the coordinates and find the bad ones (unless already done)
+    if plan is None:
+        plan = interp_prepare(coords, vol.shape, interptype=interptype)
+    coords = plan['coords']
+    bad = plan['bad']
 
     # resample the volume
-    if not np.any(np.isreal(vol)):
-        # we interpolate the real and imaginary parts independently
-        transformeddata = map_coordinates(
-            np.nan_to_num(np.real(vol)).astype(np.float64),
-            coords,
-            order=order,
-            mode='nearest') + 1j*map_coordinates(
-                np.nan_to_num(np.imag(vol)).astype(np.float64),
+    if interptype == 'cubicconv':
+        cubicconv = plan.get('cubicconv')
+        if cubicconv is None:
+            cubicconv = _cubicconv_prepare(coords, plan['volshape'])
+
+        if np.iscomplexobj(vol):
+            transformeddata = np.empty(
+                (coords.shape[1],) + vol.shape[3:], dtype=np.complex128)
+            transformeddata.real = _cubicconv(np.real(vol), cubicconv)
+            transformeddata.imag = _cubicconv(np.imag(vol), cubicconv)
+        else:
+            transformeddata = _cubicconv(vol, cubicconv)
+
+    elif np.iscomplexobj(vol):
+        # we interpolate the real and imaginary parts independently,
+        # but prefilter them as one stack
+        parts = np.empty((2,) + vol.shape, dtype=np.float64)
+        parts[0] = np.real(vol)
+        parts[1] = np.imag(vol)
+        np.nan_to_num(parts, copy=False)
+
+        if order > 1:
+            parts, npad = _spline_prefilter(parts, order)
+            coords = coords + npad
+
+        transformeddata = np.empty(coords.shape[1], dtype=np.complex128)
+        for part, out in zip(parts, (transformeddata.real,
+                                     transformeddata.imag)):
+            map_coordinates(
+                part,
                 coords,
+                output=out,
                 order=order,
-                mode='nearest')
+                mode='nearest',
+                prefilter=False)
 
     else:
         # this is the tricky 'wta' case
@@ -116,9 +402,8 @@ def interp_wrapper(vol, coords, interptype='cubic'):
             transformeddata = alllabels[wta_is]
 
             # fill in NaNs for coordinates with no label
-            # contribution and bad coordinates too
+            # contribution (bad coordinates are done below)
             transformeddata[realbad] = np.nan
-            transformeddata[bad] = np.nan
 
         # this is the usual easy case
         else:
@@ -129,6 +414,12 @@ def interp_wrapper(vol, coords, interptype='cubic'):
                 order=order,
                 mode='nearest'
             )
-            transformeddata[bad] = np.nan
+
+    # back to the order of the coordinates
+    if plan.get('order') is not None:
+        unsorted = np.empty_like(transformeddata)
+        unsorted[plan['order']] = transformeddata
+        transformeddata = unsorted
+    transformeddata[bad] = np.nan
 
     return transformeddata
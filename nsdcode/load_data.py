@@ -1,10 +1,9 @@
 """load_transform
 """
-import nibabel as nib
 import numpy as np
 
 
-__all__ = ["load_transform","load_sourcedata"]
+__all__ = ["load_transform", "load_sourcedata", "source_scaling"]
 
 
 def load_transform(casenum, tfile):
@@ -17,6 +16,8 @@ def load_transform(casenum, tfile):
     Returns:
         [type]: [description]
     """
+    import nibabel as nib
+
     # load transform
     if casenum == 1:
         a1_img = nib.load(tfile)
@@ -41,17 +42,73 @@ def load_transform(casenum, tfile):
     return a1_data
 
 
-def load_sourcedata(casenum, sourcedata):
+def _read_volumes(dataobj, volumes):
+    """read only some volumes (last dimension) of an image or array
+
+    Args:
+        dataobj (array-like): the data, e.g. a nibabel array proxy
+        volumes (int, slice, list or nd-array): 0-based indices or a boolean
+                mask over the last dimension
+
+    Raises:
+        ValueError: if <dataobj> has a single dataset (3D volume or
+                    surface vector).
+
+    Returns:
+        [nd-array]: ... x n_selected data. Consecutive volumes are read
+                    from <dataobj> as one slice, and file data are read in
+                    double format.
+    """
+    if isinstance(dataobj, np.ndarray):
+        datashape, dataclass = dataobj.shape, dataobj.dtype
+    else:
+        datashape, dataclass = dataobj.shape, np.float64
+    if len(datashape) not in (2, 4):
+        raise ValueError('<volumes> needs a source with multiple datasets.')
+
+    vol_is = np.atleast_1d(np.arange(datashape[-1])[volumes])
+
+    data = np.empty(
+        tuple(datashape[:-1]) + (vol_is.size,),
+        dtype=dataclass,
+        order='F')
+    runs = np.split(vol_is, np.flatnonzero(np.diff(vol_is) != 1) + 1)
+    pos = 0
+    for run in runs:
+        if run.size:
+            data[..., pos:pos + run.size] = dataobj[..., run[0]:run[-1] + 1]
+            pos += run.size
+
+    return data
+
+
+def load_sourcedata(casenum, sourcedata, lazy=False, volumes=None):
     """load sourcedata if str filename is passed
 
     Args:
         casenum (int): data case
         sourcedata ([type]): str or ndarray
+        lazy (bool, optional): for a volume file (cases 1 and 2), return
+                               nibabel's array proxy instead of the data,
+                               so that volumes are only read when they are
+                               indexed. The file is kept open, so reading
+                               the volumes in order decompresses a .nii.gz
+                               once. Defaults to False.
+        volumes (optional): 0-based indices (or a boolean mask) of the
+                            volumes (X x Y x Z x D sources) or datasets
+                            (V x D sources) to keep. For files, only these
+                            are read from disk. Defaults to None (all).
 
     Returns:
         [nd-array]: returns the data array if a str/path is passed
 
     """
+    import nibabel as nib
+
+    if lazy and volumes is None and isinstance(sourcedata, str) and \
+            casenum in (1, 2) and sourcedata[-4:] != '.mgz':
+        return nib.load(sourcedata, keep_file_open=True).dataobj
+
     # load sourcedata
     if isinstance(sourcedata, list):
         sdatatemp = []
@@ -59,29 +116,64 @@ def load_sourcedata(casenum, sourcedata):
         # list of paths pointing to volumes
         for p in sourcedata:
             if isinstance(p, str):
-                temp = nib.load(p).get_fdata()
+                if volumes is None:
+                    temp = nib.load(p).get_fdata()
+                else:
+                    temp = _read_volumes(nib.load(p).dataobj, volumes)
                 temp = temp.reshape([temp.shape[0], -1])
                 sdatatemp.append(temp)
                 # V-across-differentsurfaces x D
             else:
-                sdatatemp.append(p)
+                if volumes is not None:
+                    p = _read_volumes(p, volumes)
+                p = np.asarray(p)
+                sdatatemp.append(p.reshape([p.shape[0], -1]))
 
             sourcedata = np.vstack(sdatatemp)
 
     elif isinstance(sourcedata, str):
         if casenum in (1, 2, 3):
-            if sourcedata[-4:] == '.mgz':
-                source_img = nib.load(sourcedata)
+            is_mgz = sourcedata[-4:] == '.mgz'
+            source_img = nib.load(sourcedata)
+            if volumes is None:
                 sourcedata = source_img.get_fdata()
+            else:
+                # (only read the selected volumes)
+                sourcedata = _read_volumes(source_img.dataobj, volumes)
+
+            if is_mgz:
                 sourcedata = sourcedata.reshape(
                     [sourcedata.shape[0], -1],
                     order='F')  # squish
-            else:
-                source_img = nib.load(sourcedata)
-                sourcedata = source_img.get_fdata()
-                # X x Y x Z x D
+            # else X x Y x Z x D
 
     else:
         print('data array passed')
+        if volumes is not None:
+            sourcedata = _read_volumes(sourcedata, volumes)
 
     return sourcedata
+
+
+def source_scaling(sourcedata):
+    """the scaling (scl_slope, scl_inter) of an integer source file
+
+    Args:
+        sourcedata (str): the source file.
+
+    Raises:
+        ValueError: if <sourcedata> is not a file with integer data.
+
+    Returns:
+        [tuple]: (slope, inter), (1.0, 0.0) for unscaled files.
+    """
+    import nibabel as nib
+
+    if not isinstance(sourcedata, str):
+        raise ValueError('the source scaling needs a source file.')
+
+    source_img = nib.load(sourcedata)
+    if not np.issubdtype(source_img.get_data_dtype(), np.integer):
+        raise ValueError('the source scaling needs integer source data.')
+
+    return (float(source_img.dataobj.slope), float(source_img.dataobj.inter))
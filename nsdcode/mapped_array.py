@@ -0,0 +1,155 @@
+"""mapped_array
+"""
+from collections import OrderedDict
+import numpy as np
+from nsdcode.interp_wrapper import interp_wrapper as iw
+
+__all__ = ["MappedArray"]
+
+
+class MappedArray():
+    """array-like result of NSDmapdata.fit(..., lazy=True)
+
+    The shape and dtype are known up front, but a volume is only
+    interpolated when it is indexed. The most recently computed volumes
+    are kept in a small cache, so that browsing back and forth through a
+    mapped session is instant.
+
+    Indexing follows NumPy for the last (volume) axis, which accepts an
+    integer, a slice, a list of indices or a boolean mask. The remaining
+    (spatial) indices are applied to each requested volume, and the
+    volumes are stacked along the last axis. Every entry of the index
+    must refer to one axis, so np.newaxis and multidimensional boolean
+    masks raise an IndexError. np.asarray(mappedarray) computes
+    everything.
+
+    Attributes:
+        shape (tuple): targetshape (X x Y x Z or V), followed by the number
+                       of volumes D if the source is a stack.
+        dtype (dtype): the output class.
+        cache_size (int): how many computed volumes to keep.
+    """
+
+    def __init__(self, sourcedata, plan, targetshape, tr_args, cache_size=16):
+        """set up the mapping; nothing is read or interpolated yet
+
+        Args:
+            sourcedata (array-like): X x Y x Z (x D) source volume(s). This
+                    can be a nibabel array proxy, in which case volumes are
+                    also only read from disk when they are needed.
+            plan (dict): output of interp_prepare for the target coordinates.
+            targetshape (tuple): shape of one mapped volume.
+            tr_args (dict): see transform_data (uses 'interptype', 'badval'
+                    and 'outputclass').
+            cache_size (int, optional): how many computed volumes to keep.
+                    Defaults to 16.
+        """
+        self._sourcedata = sourcedata
+        self._plan = plan
+        self._targetshape = tuple(targetshape)
+        self._interptype = tr_args['interptype']
+        self._badval = tr_args['badval']
+        self._cache = OrderedDict()
+        self.cache_size = cache_size
+
+        self.dtype = np.dtype(tr_args['outputclass'])
+        if len(sourcedata.shape) == 4:
+            self._n_vols = sourcedata.shape[3]
+            self.shape = self._targetshape + (self._n_vols,)
+        else:
+            self._n_vols = None
+            self.shape = self._targetshape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'MappedArray(shape={self.shape}, dtype={self.dtype})'
+
+    def _volume(self, vol_i):
+        """interpolate (or fetch from the cache) one volume"""
+        if vol_i in self._cache:
+            self._cache.move_to_end(vol_i)
+            return self._cache[vol_i]
+
+        if vol_i is None:
+            vol = np.asarray(self._sourcedata[...])
+        else:
+            vol = np.asarray(self._sourcedata[..., vol_i])
+
+        transformeddata = iw(
+            vol, None, interptype=self._interptype, plan=self._plan)
+        transformeddata[np.isnan(transformeddata)] = self._badval
+        transformeddata = np.reshape(
+            transformeddata.astype(self.dtype),
+            self._targetshape,
+            order='F')
+
+        if self.cache_size > 0:
+            self._cache[vol_i] = transformeddata
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return transformeddata
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # every entry must index exactly one axis, so that the last one
+        # is the volume index
+        for k in key:
+            if k is None:
+                raise IndexError(
+                    'MappedArray does not support np.newaxis/None; index '
+                    'it first, then add axes to the result.')
+            if np.ndim(k) > 1 and np.asarray(k).dtype == bool:
+                raise IndexError(
+                    'MappedArray does not support multidimensional boolean '
+                    'masks; use np.nonzero(mask) or one mask per axis.')
+        if sum(k is Ellipsis for k in key) > 1:
+            raise IndexError(
+                "an index can only have a single ellipsis ('...')")
+        n_indices = sum(k is not Ellipsis for k in key)
+        if n_indices > self.ndim:
+            raise IndexError(
+                f'too many indices for MappedArray: it is {self.ndim}-'
+                f'dimensional, but {n_indices} were indexed')
+
+        # expand the ellipsis (if any) so that the last entry of the key
+        # refers to the last axis
+        if any(k is Ellipsis for k in key):
+            ell = [k is Ellipsis for k in key].index(True)
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:ell] + fill + key[ell+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # (copies, so that the cached volumes cannot be modified)
+        if self._n_vols is None:
+            return np.array(self._volume(None)[key])
+
+        spatial = key[:-1]
+        vol_is = np.arange(self._n_vols)[key[-1]]
+        if vol_is.ndim == 0:
+            return np.array(self._volume(int(vol_is))[spatial])
+
+        if vol_is.size == 0:
+            spatialshape = np.broadcast_to(
+                np.empty((), dtype=self.dtype), self._targetshape)[
+                    spatial].shape
+            return np.empty(spatialshape + (0,), dtype=self.dtype)
+
+        return np.stack(
+            [self._volume(int(vol_i))[spatial] for vol_i in vol_is],
+            axis=-1)
+
+    def __array__(self, dtype=None, copy=None):
+        transformeddata = self[...]
+        if dtype is not None:
+            transformeddata = transformeddata.astype(dtype)
+
+        return transformeddata
@@ -1,14 +1,67 @@
 """mapsurfacetovolume
 """
 import numpy as np
-from scipy import sparse
 from nsdcode.utils import zerodiv
 
 
 __all__ = ["mapsurfacetovolume"]
 
 
-def mapsurfacetovolume(data, vertices, res, specialmode, emptyval):
+def _surface_operator(vertices, res):
+    """the voxels x vertices weighting operator of mapsurfacetovolume
+
+    Args:
+        vertices (nd-array): 3 x V 1-based voxel coordinates of the vertices.
+        res (int): the volume size (res x res x res).
+
+    Returns:
+        [sparse matrix]: n_voxels x V, in csr format. Each vertex gives a
+                         weight to the 8 voxels around it, and the voxel
+                         indices are in fortran order.
+    """
+    from scipy import sparse
+
+    n_vertices = vertices.shape[1]
+    n_voxels = res**3
+
+    # each column has 8 entries with weights, the max for a weight is 3
+    voxel_is = []
+    voxel_ws = []
+    for x_n in [-1, 1]:
+        for y_n in [-1, 1]:
+            for z_n in [-1, 1]:
+
+                # calc the voxel index and the distance
+                # away from that voxel index
+                rounded = []
+                weight = np.zeros(n_vertices)
+                for dim, c_n in enumerate((x_n, y_n, z_n)):
+                    if c_n == 1:
+                        # ceil-val  (.1 means use weight of .9)
+                        c_r = np.ceil(vertices[dim, :])
+                        c_d = c_r - vertices[dim, :]
+                    else:
+                        # val-floor (.1 means use weight of .9)
+                        c_r = np.floor(vertices[dim, :])
+                        c_d = vertices[dim, :] - c_r
+                    rounded.append(c_r.astype(int) - 1)
+                    weight += 1 - c_d
+
+                # 1 x vertices with the voxel index to go to
+                voxel_is.append(np.ravel_multi_index(
+                    rounded, dims=(res, res, res), order='F'))
+                # 1 x vertices with the weight to assign
+                voxel_ws.append(weight)
+
+    # (entries for the same voxel and vertex are summed)
+    return sparse.csr_matrix(
+        (np.concatenate(voxel_ws),
+         (np.concatenate(voxel_is), np.tile(np.arange(n_vertices), 8))),
+        shape=(n_voxels, n_vertices))
+
+
+def mapsurfacetovolume(data, vertices, res, specialmode, emptyval, out=None,
+                       max_bytes=2**30):
     """mapsurfacetovolume(data, vertices, res, specialmode, emptyval)
 
     Args:
@@ -24,129 +77,85 @@ def mapsurfacetovolume(data, vertices, res, specialmode, emptyval):
                          winner-take-all voting mechanism.
         emptyval ([type]): is the value to use when no vertices map
                          to a voxel
+        out (nd-array, optional): res x res x res x n_datasets array (in
+                         fortran order, e.g. a memory-mapped output file)
+                         to write the volumes into. Defaults to None,
+                         which allocates it (float64, or int64 labels in
+                         <specialmode> with an integer <emptyval>).
+        max_bytes (int, optional): memory budget for the intermediate
+                         results. The datasets are mapped in blocks that
+                         fit into it, each block is written into <out>
+                         before the next one is mapped, and the weighting
+                         operator and sum of weights are built once for
+                         all of them. Defaults to 1 GB.
 
     Returns:
-        targetdata [nd-array]: the data mapped to a volume in <targetdata>.
+        targetdata [nd-array]: the data mapped to a volume in <targetdata>
+                         (res x res x res x n_datasets).
     """
-
     # calc/define
-    n_vertices = vertices.shape[1]   # number of vertices
     n_voxels = res**3                # number of voxels
-    n_datasets = data.shape[0]                # number of distinct datasets
-
-    # prepare some sparse-related stuff
-    vert_range = np.arange(n_vertices)
-
-    # construct X [vertices x voxels,
-    # each row has 8 entries with weights, the max for a weight is 3]
-    x_old = sparse.coo_matrix((n_vertices, n_voxels))
-    for x_n in [-1, 1]:
-        for y_n in [-1, 1]:
-            for z_n in [-1, 1]:
-
-                # calc the voxel index and the distance
-                # away from that voxel index
-                if x_n == 1:
-                    # ceil-val  (.1 means use weight of .9)
-                    x_r = np.ceil(vertices[0, :]).astype(np.int)
-                    x_d = x_r - vertices[0, :]
-                else:
-                    # val-floor (.1 means use weight of .9)
-                    x_r = np.floor(vertices[0, :]).astype(np.int)
-                    x_d = vertices[0, :] - x_r
-
-                if y_n == 1:
-                    y_r = np.ceil(vertices[1, :]).astype(np.int)
-                    y_d = y_r - vertices[1, :]
-                else:
-                    y_r = np.floor(vertices[1, :]).astype(np.int)
-                    y_d = vertices[1, :] - y_r
-
-                if z_n == 1:
-                    z_r = np.ceil(vertices[2, :]).astype(np.int)
-                    z_d = z_r - vertices[2, :]
-                else:
-                    z_r = np.floor(vertices[2, :]).astype(np.int)
-                    z_d = vertices[2, :] - z_r
-
-                # calc # 1 x vertices with the voxel index to go to
-                voxel_is = np.ravel_multi_index(
-                    (x_r-1, y_r-1, z_r-1),
-                    dims=(res, res, res),
-                    order='F')
-                # 1 x vertices with the weight to assign
-                voxel_w = (1 - x_d) + (1 - y_d) + (1 - z_d)
-
-                # construct the entries and add the old one in
-                x_new = sparse.coo_matrix(
-                    (voxel_w, (vert_range, voxel_is)),
-                    shape=(n_vertices, n_voxels))
-                x_new = x_old + x_new
-                x_old = x_new
+    n_datasets = data.shape[0]       # number of distinct datasets
+
+    # construct X [voxels x vertices], and the sum of the weights of each
+    # voxel, which is needed to turn the weighted sum of vertex values
+    # into a weighted average
+    operator = _surface_operator(vertices, res)
+    wtssum = np.asarray(operator.sum(axis=1)).ravel()   # voxels
+
+    if out is None:
+        if specialmode == 0:
+            dtype = np.float64
+        else:
+            dtype = np.result_type(np.int64, np.asarray(emptyval))
+        out = np.empty((res, res, res, n_datasets), dtype=dtype, order='F')
+    transformeddata = out.reshape((n_voxels, n_datasets), order='F')
+    if not np.shares_memory(transformeddata, out):
+        raise ValueError('<out> must be in fortran order.')
 
     # do it
     if specialmode == 0:
 
-        # each voxel is assigned a weighted sum of vertex values.
-        # this should be done as a weighted average.
-        # thus, need to divide by sum of weights.
-        # let's compute that now.
-        wtssum = np.ones(n_vertices) * x_new   # 1 x voxels
-
-        # take the vertex data and map to voxels
-        transformeddata = data * x_new      # n_datasets x voxels
-
-        # do the normalization
+        # each voxel is assigned a weighted sum of vertex values, divided
+        # by the sum of weights, one block of datasets at a time
         # [if a voxel has no vertex contribution, it gets <emptyval>]
-        transformeddata = zerodiv(
-            transformeddata,
-            np.tile(wtssum, n_datasets),
-            emptyval)
-
-        # prepare the results
-        transformeddata = np.reshape(
-            transformeddata.T,
-            [res, res, res, n_datasets],
-            order='F')
+        blocksize = max(1, max_bytes // (n_voxels * 8))
+        for start in range(0, n_datasets, blocksize):
+            block = operator @ data[start:start+blocksize].T
+            zerodiv(block, wtssum[:, np.newaxis], emptyval, out=block)
+            transformeddata[:, start:start+blocksize] = block
 
     else:
 
+        # which voxels have no vertex contribution?
+        bad = wtssum == 0
+
         # loop over datasets
-        transformeddata = []
-        for data_q in np.arange(n_datasets):
+        for data_q in range(n_datasets):
 
             # figure out discrete integer labels
-            all_labels = np.unique(data[data_q, :]).astype(np.int).flatten()
+            all_labels = np.unique(data[data_q, :]).astype(int).flatten()
             assert np.all(np.isfinite(all_labels))
 
-            # expand data into separate channels
-            # n_voxels x vertices
-            data_new = np.zeros((len(all_labels), data.shape[1]))
-            for c_label in all_labels:
-                data_new[c_label, :] = data[data_q, :] == c_label
-
-            # take the vertex data and map to voxels
-            mapped = data_new*x_new      # n_voxels x voxels
-
-            # which voxels have no vertex contribution?
-            bad = np.sum(mapped, axis=0) == 0
-
-            # perform winner-take-all
-            # (mapped is the index relative to all_labels!)
-            mapped = np.argmax(mapped, axis=0)
+            # perform winner-take-all, mapping one label (as a binary
+            # vertex vector) at a time
+            best = None
+            for label_i, c_label in enumerate(all_labels):
+                mapped = operator @ (data[data_q, :] == c_label).astype(
+                    np.float64)
+                if best is None:
+                    best = mapped
+                    winner = np.zeros(n_voxels, dtype=int)
+                else:
+                    better = mapped > best
+                    best[better] = mapped[better]
+                    winner[better] = label_i
 
             # figure out the final labeling scheme
-            finaldata = all_labels[mapped]
+            finaldata = all_labels[winner]
 
             # put in <emptyval>
-            finaldata[bad] = emptyval
-
-            # save
-            transformeddata.append(
-                np.reshape(
-                    finaldata,
-                    [res, res, res],
-                    order='F')
-                )
+            transformeddata[:, data_q] = finaldata
+            transformeddata[bad, data_q] = emptyval
 
-    return transformeddata
+    return out
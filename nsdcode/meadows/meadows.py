@@ -5,9 +5,10 @@ import os
 import glob
 import re
 import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from PIL import Image
-from .utils import reorder_rdm
+from .utils import reorder_rdm, reorder_rdms
 
 
 __all__ = [
@@ -16,7 +17,14 @@ __all__ = [
     "get_matask_stim",
     "get_stim_ids",
     "get_matask",
-    "get_dragrate"]
+    "get_dragrate",
+    "get_matask_all",
+    "get_dragrate_all",
+    "get_dragrate_table"]
+
+
+# parsed json files, keyed by path: ((mtime, size), data_store)
+_data_stores = {}
 
 
 def meadows_subjects(subj):
@@ -53,44 +61,101 @@ def load_json_data(data_dir):
         data_dir ([path]): [path to the dataframe]
 
     Returns:
-        [dict]: [ma task data_frame]
+        [dict]: [ma task data_frame]. The parsed file is cached by path,
+                modification time and size, so later calls return the same
+                (shared) dict without reading the file again. Do not modify
+                it in place.
     """
-    json_file = os.path.join(
+    json_file = os.path.abspath(os.path.join(
         data_dir,
-        'Meadows_nsd-multiple-arrangements_v_v2_tree.json')
+        'Meadows_nsd-multiple-arrangements_v_v2_tree.json'))
     # Read in the meadows json file
 
-    with open(json_file, 'r') as file_data:
-        data_store = json.load(file_data)
-    # Get the multiple arrangements data
+    stat = os.stat(json_file)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _data_stores.get(json_file)
+    if cached is None or cached[0] != version:
+        with open(json_file, 'r') as file_data:
+            _data_stores[json_file] = (version, json.load(file_data))
+    # Get the multiple arrangements data (parsed only once per version
+    # of the file)
+
+    return _data_stores[json_file][1]
+
+
+def _load_stim(stim, size):
+    """[decode and bicubic-resize one stimulus png]"""
+    from PIL import Image
 
-    return data_store
+    with Image.open(stim) as image:
+        return np.asarray(image.resize(size=size, resample=Image.BICUBIC))
 
 
 # Get Stimulus ID for Special 100
-def get_matask_stim(data_dir='Data'):
+def get_matask_stim(data_dir='Data', cache_dir=None, n_jobs=None):
     """[return special 100 stimuli]
 
     Args:
         data_dir ([path]): [where is the data]
-        stim_ids [list]: [names of the sorted stimuli]
+        cache_dir ([path], optional): [where to keep the resized stack].
+                    Defaults to data_dir/special100. If the directory is
+                    not writable, nothing is cached.
+        n_jobs ([int], optional): [number of threads used to decode and
+                    resize the images]. Defaults to None (python's default).
 
     Returns:
         images [dict]: dict of stimuli images with key stim_id
                        and value image array
+
+    The first call decodes and resizes the pngs in a thread pool, and
+    stores the resized stack as a single .npy file keyed by the size and
+    the names and modification times of the pngs. Later calls load all
+    images with one contiguous read. When the pngs change, the new stack
+    replaces the old one.
     """
     size = 128, 128
-    stim_list = glob.glob(os.path.join(data_dir, 'special100', '*.png'))
-
-    images = {
-        re.split(
-            '\\\\',
-            stim)[2][:-4]: np.asarray(
-                Image.open(
-                    stim).resize(
-                        size=size,
-                        resample=Image.BICUBIC)
-                        ) for stim in stim_list}
+    stim_list = sorted(
+        glob.glob(os.path.join(data_dir, 'special100', '*.png')))
+    stim_keys = [
+        os.path.splitext(os.path.basename(stim))[0] for stim in stim_list]
+
+    # cache file keyed by size and source files
+    if cache_dir is None:
+        cache_dir = os.path.join(data_dir, 'special100')
+    sources = [
+        (key, os.stat(stim).st_mtime_ns)
+        for key, stim in zip(stim_keys, stim_list)]
+    digest = hashlib.sha1(repr((size, sources)).encode()).hexdigest()[:16]
+    cache_file = os.path.join(
+        cache_dir, f'special100_{size[0]}x{size[1]}_{digest}.npy')
+
+    if os.path.exists(cache_file):
+        stims = np.load(cache_file)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            stims = list(pool.map(lambda stim: _load_stim(stim, size),
+                                  stim_list))
+
+        # only same-shaped images can be stored as one stack
+        if stims and len({stim.shape for stim in stims}) == 1:
+            stims = np.stack(stims)
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_file, 'wb') as file_data:
+                    np.save(file_data, stims)
+                os.replace(tmp_file, cache_file)
+
+                # drop the stacks of earlier versions of the pngs
+                for stale in glob.glob(os.path.join(
+                        cache_dir,
+                        f'special100_{size[0]}x{size[1]}_*.npy')):
+                    if stale != cache_file:
+                        os.remove(stale)
+            except OSError:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    images = dict(zip(stim_keys, stims))
     # Get a dictionary of stimulus images and IDs
 
     return images
@@ -126,6 +191,21 @@ def get_stim_ids(data_store, subject):
     return stim_ids, indcs
 
 
+def _get_matask(data_store, this_subject):
+    """[fetch the multiple arrangements data from a parsed data_store]"""
+
+    stim_ids, indcs = get_stim_ids(data_store, this_subject)
+    # Get stim ids and sorting indices
+
+    this_data = data_store[this_subject]['tasks'][1]['rdm']
+    # Extract that subject's RDM from the json datastore
+
+    rdm_utv = reorder_rdm(this_data, indcs)
+    # Reorder rdm according to sorting indices
+
+    return rdm_utv, stim_ids
+
+
 def get_matask(data_dir, sub):
     """[fetch the multiple arrangements data]
 
@@ -142,16 +222,97 @@ def get_matask(data_dir, sub):
     data_store = load_json_data(data_dir)
     # Get the data
 
-    stim_ids, indcs = get_stim_ids(data_store, this_subject)
-    # Get stim ids and sorting indices
+    return _get_matask(data_store, this_subject)
 
-    this_data = data_store[this_subject]['tasks'][1]['rdm']
-    # Extract that subject's RDM from the json datastore
 
-    rdm_utv = reorder_rdm(this_data, indcs)
-    # Reorder rdm according to sorting indices
+def get_matask_all(data_dir, subs=None):
+    """[fetch the multiple arrangements data of several subjects at once]
 
-    return rdm_utv, stim_ids
+    Args:
+        data_dir ([path]): [where is the data]
+        subs ([list], optional): [subject keys]. Defaults to all subjects.
+
+    Returns:
+        rdms [array]: [n_subjects x n_pairs upper triangular vectors]
+        stim_ids [list]: [the sorted stim ids of each subject]
+    """
+    if subs is None:
+        subs = sorted(meadows_subjects('subj01')[1])
+
+    data_store = load_json_data(data_dir)
+    # Get the data (a single parse for all subjects)
+
+    subjects = [meadows_subjects(sub)[0] for sub in subs]
+    sortings = [get_stim_ids(data_store, subject) for subject in subjects]
+    stim_ids = [c_stim_ids for c_stim_ids, _ in sortings]
+
+    raw_rdms = np.vstack(
+        [data_store[subject]['tasks'][1]['rdm'] for subject in subjects])
+    # Stack the RDMs of all subjects
+
+    orders = {}
+    for sub_i, (_, indcs) in enumerate(sortings):
+        orders.setdefault(tuple(indcs), []).append(sub_i)
+
+    rdms = np.empty_like(raw_rdms)
+    for order, sub_is in orders.items():
+        rdms[sub_is] = reorder_rdms(raw_rdms[sub_is], order)
+    # Reorder the subjects that share a sorting with a single gather
+
+    return rdms, stim_ids
+
+
+def _dragrate_columns(data_store, t_sub, task):
+    """[parse the positions of every run of a drag-rate task into columns]
+
+    Args:
+        data_store ([json]): [ma task json data_store]
+        t_sub ([string]): [meadows subject name]
+        task ([string]): [drag-rate task]
+
+    Returns:
+        runs [1D array]: [run number (1-based) of each position]
+        stims [1D array]: [nsd id of each position]
+        x [1D array]: [x of each position (the confidence)]
+        y [1D array]: [y of each position (the score)]
+    """
+    tasks = data_store[t_sub]['tasks']
+    # find the dragrate task (the first match is not a rating run)
+    task_is = [i for i, k in enumerate(tasks) if task in k['task']['name']]
+
+    columns = [[], [], [], []]
+    for run_i, run in enumerate(task_is[1:]):
+        positions = tasks[run]['positions']
+        n_pos = len(positions)
+        columns[0].append(np.full(n_pos, run_i + 1))
+        columns[1].append(np.fromiter(
+            (pos['name'].split('nsd')[1] for pos in positions),
+            dtype=np.int64, count=n_pos))
+        columns[2].append(np.fromiter(
+            (pos['x'] for pos in positions), dtype=np.float64, count=n_pos))
+        columns[3].append(np.fromiter(
+            (pos['y'] for pos in positions), dtype=np.float64, count=n_pos))
+
+    runs, stims, x, y = [np.concatenate(column) for column in columns]
+
+    return runs, stims, x, y
+
+
+def _get_dragrate(data_store, t_sub, task):
+    """[fetch the drag-rate data from a parsed data_store]"""
+
+    _, stims, x, y = _dragrate_columns(data_store, t_sub, task)
+    stims = stims.astype(np.float64)
+
+    reordering = np.argsort(stims)
+
+    scores = y[reordering]
+
+    confidence = x[reordering]
+
+    stims = stims[reordering]
+
+    return scores, confidence, stims
 
 
 def get_dragrate(data_dir, sub, task='valence'):
@@ -172,36 +333,70 @@ def get_dragrate(data_dir, sub, task='valence'):
     data_store = load_json_data(data_dir)
     # Get the data
 
-    stim_ids, indcs = get_stim_ids(data_store, t_sub)
-    # Get stim ids and sorting indices
-    # find the dragrate task
-    task_is = \
-        [i for i, k in enumerate(
-            data_store[t_sub]['tasks']
-            ) if task in k['task']['name']]
+    return _get_dragrate(data_store, t_sub, task)
+
+
+def get_dragrate_all(data_dir, subs=None, tasks=('valence', 'arousal')):
+    """[fetch the drag-rate data of several subjects and tasks at once]
+
+    Args:
+        data_dir ([path]): [where is the data]
+        subs ([list], optional): [subject keys]. Defaults to all subjects.
+        tasks ([list], optional): [drag-rate tasks].
+                                  Defaults to ('valence', 'arousal').
 
-    task_items = []
-    for run in task_is[1:]:
+    Returns:
+        [dict]: [(sub, task) -> (scores, confidence, stims), as returned
+                 by get_dragrate]
+    """
+    if subs is None:
+        subs = sorted(meadows_subjects('subj01')[1])
 
-        run_items = [[int(
-            re.split(
-                'nsd',
-                pos['name']
-                )[1]),
-            pos['x'],
-            pos['y']
-         ] for pos in data_store[t_sub]['tasks'][run]['positions']]
+    data_store = load_json_data(data_dir)
+    # Get the data (a single parse for all subjects and tasks)
 
-        task_items.append(run_items)
+    return {
+        (sub, task): _get_dragrate(data_store, meadows_subjects(sub)[0], task)
+        for sub in subs for task in tasks}
 
-    task_items = np.vstack(task_items)
 
-    reordering = np.argsort(task_items[:, 0])
+def get_dragrate_table(data_dir, subs=None, tasks=('valence', 'arousal')):
+    """[fetch the drag-rate data of several subjects and tasks as a table]
 
-    scores = task_items[reordering, 2]
+    Args:
+        data_dir ([path]): [where is the data]
+        subs ([list], optional): [subject keys]. Defaults to all subjects.
+        tasks ([list], optional): [drag-rate tasks].
+                                  Defaults to ('valence', 'arousal').
 
-    confidence = task_items[reordering, 1]
+    Returns:
+        [DataFrame]: [one row per rated stimulus, with the columns subject,
+                      task, run, stim_id, x (confidence) and y (score), in
+                      the order of the runs]
+    """
+    import pandas as pd
 
-    stims = task_items[reordering, 0]
+    if subs is None:
+        subs = sorted(meadows_subjects('subj01')[1])
 
-    return scores, confidence, stims
+    data_store = load_json_data(data_dir)
+    # Get the data (a single parse for all subjects and tasks)
+
+    tables = []
+    for sub in subs:
+        t_sub = meadows_subjects(sub)[0]
+        for task in tasks:
+            runs, stims, x, y = _dragrate_columns(data_store, t_sub, task)
+            tables.append(pd.DataFrame({
+                'subject': sub,
+                'task': task,
+                'run': runs,
+                'stim_id': stims,
+                'x': x,
+                'y': y}))
+
+    table = pd.concat(tables, ignore_index=True)
+    table['subject'] = table['subject'].astype('category')
+    table['task'] = table['task'].astype('category')
+
+    return table
@@ -1,5 +1,72 @@
+from functools import lru_cache
 import numpy as np
-from scipy.spatial.distance import squareform
+
+
+@lru_cache(maxsize=32)
+def _condensed_permutation(n_conds, new_order):
+    """[condensed-vector indices that reorder an RDM]
+
+    Args:
+        n_conds ([int]): number of conditions of the original RDM
+        new_order ([tuple]): condition list order
+
+    Returns:
+        perm [1D array]: for each pair of the reordered utv, the index of
+                         that pair in the original utv
+        diag [1D array]: pairs that fall on the diagonal (repeated
+                         conditions in new_order), or None
+
+    Both arrays are read-only, since they are shared by every caller
+    through the cache.
+    """
+    order = np.asarray(new_order, dtype=np.intp)
+    rows, cols = np.triu_indices(len(order), k=1)
+    i = order[rows]
+    j = order[cols]
+    low = np.minimum(i, j)
+    high = np.maximum(i, j)
+    # index of pair (low, high) in the condensed (upper-triangular) vector
+    perm = n_conds*low - low*(low + 1)//2 + (high - low - 1)
+
+    diag = low == high
+    if diag.any():
+        perm[diag] = 0
+        diag.flags.writeable = False
+    else:
+        diag = None
+
+    perm.flags.writeable = False
+    return perm, diag
+
+
+def reorder_rdms(utvs, new_order):
+    """[reorder a stack of RDMs without going through square matrices]
+
+    Args:
+        utvs ([array]): upper-triangular vector(s), n_pairs or
+                        n_subjects x n_pairs
+        new_order ([1D array]): condition list order
+
+    Returns:
+        [reordered utvs]: reordered utvs, with the same leading dimensions.
+
+    The permutation of the condensed vector is computed once per order
+    (and cached), and applied to all RDMs as a single gather.
+    """
+    utvs = np.asarray(utvs)
+    n_pairs = utvs.shape[-1]
+    n_conds = int(round((1 + np.sqrt(1 + 8*n_pairs))/2))
+    if n_conds*(n_conds - 1)//2 != n_pairs:
+        raise ValueError(
+            f'{n_pairs} is not the length of an upper-triangular vector.')
+
+    perm, diag = _condensed_permutation(
+        n_conds, tuple(int(i) for i in new_order))
+    reordered = utvs[..., perm]
+    if diag is not None:
+        reordered[..., diag] = 0
+
+    return reordered
 
 
 def reorder_rdm(utv, new_order):
@@ -12,8 +79,4 @@ def reorder_rdm(utv, new_order):
     Returns:
         [reordered utv]: reordered utv.
     """
-    ax, bx = np.ix_(new_order, new_order)
-    # Create an open mesh of new_order x new_order
-    new_order_rdm = squareform(utv)[ax, bx]
-    # Reorganise
-    return squareform(new_order_rdm, 'tovector', 0)
\ No newline at end of file
+    return reorder_rdms(utv, new_order)
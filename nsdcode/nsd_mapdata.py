@@ -1,23 +1,207 @@
 """nsd_mapdata
 """
-import os
-from nsdcode.nsd_datalocation import nsd_datalocation
+import numpy as np
 from nsdcode.parse_case import parse_case
-from nsdcode.load_data import load_transform, load_sourcedata
+from nsdcode.load_data import load_transform, load_sourcedata, source_scaling
+from nsdcode.compose_transforms import compose_transforms
+from nsdcode.compact_field import CompactField
+from nsdcode.results_cache import ResultsCache
+from nsdcode.transform_index import TransformIndex, space_geometry
 from nsdcode.transform_data import transform_data
+from nsdcode.nsd_output import nsd_write_fs
+from nsdcode.utils import zerodiv
 
 __all__ = ["NSDmapdata"]
 
 
+def _mask_indices(mask, targetshape):
+    """turn a target-space mask into 0-based indices
+
+    Args:
+        mask (nd-array or list): a boolean volume (X x Y x Z) or vector (V),
+                    or a list of 0-based indices (in fortran order for
+                    volumes).
+        targetshape (tuple): shape of the target space.
+
+    Raises:
+        ValueError: if a boolean mask does not match <targetshape>, or the
+                    indices are not integers in 0 .. n_locations-1.
+
+    Returns:
+        [nd-array]: the indices of the locations in the mask.
+    """
+    mask = np.asarray(mask)
+    n_locations = int(np.prod(targetshape))
+    if mask.dtype == bool:
+        if mask.size != n_locations:
+            raise ValueError(
+                f'<mask> has {mask.size} elements but the target space '
+                f'has {n_locations} locations.')
+        return np.flatnonzero(mask.ravel(order='F'))
+
+    if mask.size == 0:
+        return np.zeros(0, dtype=int)
+    if not np.issubdtype(mask.dtype, np.integer):
+        raise ValueError(
+            f'<mask> must be boolean or integer indices, not {mask.dtype}.')
+    if mask.min() < 0 or mask.max() >= n_locations:
+        raise ValueError(
+            f'<mask> indices must be in 0 .. {n_locations - 1} (0-based, '
+            f'in fortran order for volumes).')
+
+    return mask.astype(int).ravel()
+
+
 class NSDmapdata():
 
-    def __init__(self, base_dir):
-        """[summary]
+    def __init__(self, base_dir, cache_transforms=False,
+                 compact_transforms=None, cache_dir=None,
+                 cache_size=10 * 2**30):
+        """set up the mapping of data for the nsd_data in <base_dir>
 
         Args:
             base_dir ([os.path]): directory where the nsd_data lives
+            cache_transforms (bool, optional): keep every transform that
+                    is loaded in memory, so that later calls to fit that
+                    use the same transform do not load it again. This is
+                    worthwhile when mapping many datasets of one subject,
+                    but note that volume-to-volume transforms are large
+                    (e.g. ~3 GB for anat0pt5). Defaults to False.
+            compact_transforms (dtype, optional): keep the cached
+                    volume-to-volume transforms in fixed point with this
+                    integer type (e.g. np.int16, which takes a quarter of
+                    the memory), see CompactField for the precision. Only
+                    used with <cache_transforms>. Defaults to None, which
+                    keeps them in float64.
+            cache_dir (path, optional): keep the results of fit in this
+                    directory (see ResultsCache), so that mapping the same
+                    data again, even from another session or process,
+                    only reads the stored result. Results are keyed by
+                    the arguments of fit and by the identity of the source
+                    and transform files (path, size and modification time)
+                    or the content of source arrays. Calls with
+                    <outputfile>, <lazy> or <sink> are not cached.
+                    Defaults to None, which caches nothing.
+            cache_size (int, optional): disk budget of <cache_dir> in
+                    bytes; the least recently used results are deleted
+                    beyond it. Defaults to 10 GB.
         """
         self.base_dir = base_dir
+        self.cache_transforms = cache_transforms
+        self.compact_transforms = compact_transforms
+        if cache_dir is not None:
+            self.results_cache = ResultsCache(cache_dir, cache_size)
+        else:
+            self.results_cache = None
+
+        # transforms loaded so far (if cache_transforms), keyed by file(s)
+        self._transforms = {}
+
+        # composite transforms, keyed by (subjix, route)
+        self._composites = {}
+
+        # transform directory indexes, keyed by subjix
+        self._indexes = {}
+
+    def transform_index(self, subjix):
+        """the TransformIndex of a subject (scanned on first use)
+
+        Args:
+            subjix (int): the subject number 1-8
+
+        Returns:
+            [TransformIndex]: the transforms available for this subject,
+                    with their shapes and dtypes.
+        """
+        if subjix not in self._indexes:
+            self._indexes[subjix] = TransformIndex.for_subject(
+                self.base_dir, subjix)
+
+        return self._indexes[subjix]
+
+    def _load_composite(self, subjix, route, index):
+        """load (or reuse) the composite transform for a multi-hop route
+
+        Args:
+            subjix (int): the subject number 1-8
+            route (list): the spaces visited, from source to target
+            index (TransformIndex): the subject's transforms
+
+        Returns:
+            casenum, a1_data: see compose_transforms
+        """
+        key = (subjix, tuple(route))
+        if key not in self._composites:
+            transforms = []
+            for hopsource, hoptarget in zip(route[:-1], route[1:]):
+                casenum, tfile = parse_case(hopsource, hoptarget, index.tdir)
+                if casenum == 4:
+                    raise ValueError(
+                        'nativesurface-to-volume hops cannot be composed.')
+                if tfile is None:
+                    raise ValueError(
+                        'anat-to-anat hops cannot be composed.')
+                index.check(tfile)
+                transforms.append((casenum, load_transform(casenum, tfile)))
+            self._composites[key] = compose_transforms(transforms)
+
+        return self._composites[key]
+
+    def _get_transform(self, subjix, sourcespace, targetspace, via, index):
+        """figure out the case and load the transform for one target
+
+        Returns:
+            casenum, a1_data: see parse_case and load_transform
+        """
+        if via is None:
+            casenum, tfile = parse_case(sourcespace, targetspace, index.tdir)
+            if tfile is None:
+                # anat-to-anat is resampled analytically (see transform_data)
+                return casenum, None
+            index.check(tfile)
+            if not self.cache_transforms:
+                return casenum, load_transform(casenum, tfile)
+
+            key = tuple(tfile) if isinstance(tfile, list) else tfile
+            if key not in self._transforms:
+                a1_data = load_transform(casenum, tfile)
+                if casenum == 1 and self.compact_transforms is not None:
+                    a1_data = CompactField.encode(
+                        a1_data, self.compact_transforms)
+                self._transforms[key] = a1_data
+
+            return casenum, self._transforms[key]
+
+        if isinstance(sourcespace, list):
+            raise ValueError('<via> needs a single <sourcespace>.')
+        if isinstance(via, str):
+            via = [via]
+        route = [sourcespace] + list(via) + [targetspace]
+
+        return self._load_composite(subjix, route, index)
+
+    def _transform_files(self, sourcespace, targetspace, via, index):
+        """the transform file(s) that a fit call reads"""
+        targetspaces = targetspace
+        if not isinstance(targetspaces, list):
+            targetspaces = [targetspaces]
+
+        hops = []
+        for c_space in targetspaces:
+            if via is None:
+                hops.append((sourcespace, c_space))
+            else:
+                route = [sourcespace] + (
+                    [via] if isinstance(via, str) else list(via)) + [c_space]
+                hops.extend(zip(route[:-1], route[1:]))
+
+        tfiles = []
+        for hopsource, hoptarget in hops:
+            _, tfile = parse_case(hopsource, hoptarget, index.tdir)
+            if tfile is not None:
+                tfiles.extend(tfile if isinstance(tfile, list) else [tfile])
+
+        return tfiles
 
     def fit(self,
             subjix,
@@ -29,8 +213,17 @@ class NSDmapdata():
             outputfile=None,
             outputclass=None,
             fsdir=None,
+            n_jobs=None,
+            via=None,
+            average=False,
+            lazy=False,
+            sink=False,
+            mask=None,
+            volumes=None,
+            quantize=None,
+            compresslevel=1,
             ):
-        """nsa_mapdata is used to map functional data between coordinate systems
+        """nsa_mapdata maps functional data between coordinate systems
 
         Arguments:
         __________
@@ -40,8 +233,13 @@ class NSDmapdata():
         sourcespace (['string']): is a string indicating the source space
                     (where the data currently are)
 
-        targetspace (['string']): is a string indicating target space
-                    (where the data need to go)
+        targetspace (['string' or list]): is a string indicating target space
+                    (where the data need to go). For volume-to-nativesurface
+                    mappings (case 2), this can also be a list of surfaces
+                    (e.g. ['lh.layerB1', 'lh.layerB2', 'lh.layerB3']). The
+                    source is then loaded once and interpolated at the
+                    vertices of all surfaces in one go, and a list with one
+                    result per surface is returned (see also <average>).
 
         sourcedata ([array or file]):
                     (1) one or more 3D volumes (X x Y x Z x D)
@@ -50,7 +248,10 @@ class NSDmapdata():
                     (4) a .mgz file with one or more surface vectors
 
         interptype (['string', optional]): interpolation type. options are
-                    'nearest' | 'linear' | 'cubic'. Default: 'cubic'.
+                    'nearest' | 'linear' | 'cubic' | 'cubicconv'.
+                    Default: 'cubic'. 'cubicconv' is cubic convolution (as
+                    in the MATLAB version) instead of a cubic B-spline; it
+                    needs no prefilter and is faster for many volumes.
                     Special cases are 'wta' and 'surfacewta'
                     (more details below).
         badval ([type], optional): is the value to use for invalid locations.
@@ -59,6 +260,10 @@ class NSDmapdata():
         outputfile (['string' or None]):
                     (1) a file.nii or file.nii.gz file to write to
                     (2) a [lh,rh].file.mgz file to write to
+                    (3) a list of [lh,rh].file.mgz files, one for each
+                        surface in <targetspace>
+                    Surface files hold one frame per dataset, in the
+                    <outputclass> if MGH supports it (see nsd_write_fs).
                     Default is None which means to not write out a file.
 
         outputclass ([string]): is the output format to use (e.g. 'single').
@@ -72,10 +277,93 @@ class NSDmapdata():
                     into <fsdir>. This input is needed only when writing .mgz
                     files.
 
+        n_jobs ([int, optional]): number of worker processes to use when
+                    <sourcedata> contains multiple 3D volumes (cases 1 and
+                    2). The transform coordinates and the source volumes
+                    are placed in shared memory once (a source file is read
+                    straight into it) and every worker attaches to them
+                    without copying. -1 means to use all cpus. Default is
+                    None which means to interpolate the volumes serially in
+                    this process.
+
+        via (['string' or list, optional]): one or more intermediate spaces
+                    to go through on the way from <sourcespace> to
+                    <targetspace>, e.g. 'lh.white' to go from 'func1pt8' to
+                    'fsaverage', or 'func1pt0' to go from 'MNI' to
+                    'lh.layerB2'. The transforms of all hops are composed
+                    into a single transform (cached in this NSDmapdata
+                    instance), so the data are read and interpolated only
+                    once instead of once per hop. Default is None which
+                    means to use the direct transform.
+
+        average ([bool, optional]): when <targetspace> is a list of surfaces
+                    with the same vertices (e.g. the three layers of one
+                    hemisphere), return (and write to the single
+                    <outputfile>) the average across surfaces instead of a
+                    list. Invalid locations are left out of the average.
+                    Default: False.
+
+        lazy ([bool, optional]): for volume-to-volume and
+                    volume-to-nativesurface mappings (cases 1 and 2), return
+                    a MappedArray instead of the data. Its shape and dtype
+                    are known right away, but each volume is only read and
+                    interpolated when it is indexed (e.g. result[..., 10:20]),
+                    and recently computed volumes are cached. Cannot be
+                    combined with <outputfile>. Default: False.
+
+        sink ([bool, optional]): for volume-to-volume and
+                    nativesurface-to-volume mappings (cases 1 and 4),
+                    preallocate <outputfile> (which must be an uncompressed
+                    .nii, or a .npy) with the right header and affine, write
+                    every mapped volume straight into it, and return a
+                    memory-mapped view of the file. This avoids holding the
+                    whole result in memory. Default: False.
+
+        mask ([array or list, optional]): restrict the mapping to part of the
+                    target space (cases 1 to 3), given as a boolean volume
+                    (X x Y x Z) or vector (V) in the target space, or as a
+                    list of 0-based indices (in fortran order for volumes).
+                    Only these locations are interpolated, and fit returns
+                    <transformeddata>, <maskindices> where
+                    <transformeddata> is ROI x D (or ROI) and <maskindices>
+                    are the 0-based indices of its rows. Cannot be combined
+                    with <outputfile>. Default is None.
+
+        volumes ([int, list or array, optional]): 0-based indices (or a
+                    boolean mask) of the volumes (X x Y x Z x D sources) or
+                    datasets (V x D sources) to map, e.g. the trials of
+                    interest in a session of betas. For files, only these
+                    volumes are read from disk (consecutive volumes in one
+                    read), and only these are mapped. Default is None which
+                    means to map all of them.
+
+        quantize ([string or tuple, optional]): store the volume
+                    <outputfile> (cases 1 and 4) as int16 with a scl_slope
+                    and scl_inter, which makes it 2 (float32) to 4 (float64)
+                    times smaller: 'int16' chooses the scaling from the
+                    range of each file, so that every value is within half
+                    a step (1/65535 of the range) of the stored one, and 0
+                    stays exact; 'source' uses the scaling of the (integer)
+                    source file, e.g. int16 betas, clipping the values that
+                    interpolation pushes out of its range; a (slope, inter)
+                    tuple uses that scaling. NaNs are stored as 0. The
+                    returned data are not quantized. Cannot be combined
+                    with <sink>. Default is None which means to store the
+                    <outputclass>.
+
+        compresslevel ([int, optional]): gzip compression level (1-9) of
+                    .mgz <outputfile>s; higher levels make smaller files,
+                    but take longer to write. Default: 1.
+
         Returns:
         ________
 
-        transformeddata: [array] data mapped to targetspace.
+        transformeddata: [array] data mapped to targetspace (a list of arrays
+                    for a list of <targetspace>, a MappedArray if <lazy>,
+                    a memory-mapped view of <outputfile> if <sink>).
+
+        maskindices: [array] only if <mask> is given, the 0-based indices
+                    of the target locations in <transformeddata>.
 
 
         There are four types of use-cases:
@@ -85,9 +373,13 @@ class NSDmapdata():
 
 
         This includes [anat* | func* | MNI] -> [anat* | func* | MNI].
-        Note that within-space transforms are not implemented
-        (e.g. anat1pt0 to anat0pt8), but that is probably not very
-        useful anyway.
+        Note that within-space transforms are implemented for anat
+        (e.g. anat1pt0 to anat0pt8), but not for func. The anat spaces
+        share the same field-of-view, so these need no transform file:
+        like in the MATLAB version, each volume is low-pass filtered at
+        the new resolution and resampled with cubic convolution, one axis
+        at a time (see changevolumeres). <interptype> is ignored, except
+        for 'wta'.
 
         (2) volume-to-nativesurface:
         ____________________________
@@ -170,11 +462,65 @@ class NSDmapdata():
         origin = [183-91 127 73]
 
         """
+        args = {
+            'subjix': subjix,
+            'sourcespace': sourcespace,
+            'targetspace': targetspace,
+            'sourcedata': sourcedata,
+            'interptype': interptype,
+            'badval': badval,
+            'outputfile': outputfile,
+            'outputclass': outputclass,
+            'fsdir': fsdir,
+            'n_jobs': n_jobs,
+            'via': via,
+            'average': average,
+            'lazy': lazy,
+            'sink': sink,
+            'mask': mask,
+            'volumes': volumes,
+            'quantize': quantize,
+            'compresslevel': compresslevel}
+
+        if self.results_cache is None or \
+                outputfile is not None or lazy or sink:
+            return self._fit(**args)
+
+        # key the result by everything it depends on (but not by n_jobs)
+        try:
+            key = self.results_cache.key(
+                subjix,
+                sourcespace,
+                targetspace,
+                sourcedata,
+                'cubic' if interptype is None else interptype,
+                0 if badval is None else badval,
+                outputclass,
+                via,
+                average,
+                mask,
+                volumes,
+                self._transform_files(
+                    sourcespace, targetspace, via,
+                    self.transform_index(subjix)))
+        except (TypeError, OSError):
+            # (e.g. a nibabel image, or an unknown space)
+            return self._fit(**args)
+
+        transformeddata = self.results_cache.get(key)
+        if transformeddata is None:
+            transformeddata = self._fit(**args)
+            self.results_cache.put(key, transformeddata)
+
+        return transformeddata
+
+    def _fit(self, subjix, sourcespace, targetspace, sourcedata, interptype,
+             badval, outputfile, outputclass, fsdir, n_jobs, via, average,
+             lazy, sink, mask, volumes, quantize, compresslevel):
+        """see fit"""
 
         # setup
-        nsd_path = nsd_datalocation(self.base_dir)
-        tdir = os.path.join(f'{nsd_path}', 'ppdata',
-                            f'subj{subjix:02d}', 'transforms')
+        index = self.transform_index(subjix)
 
         # set default interptype
         if interptype is None:
@@ -184,39 +530,86 @@ class NSDmapdata():
         if badval is None:
             badval = 0
 
-        # figure out which case
-        casenum, tfile = parse_case(sourcespace, targetspace, tdir)
-
         # for writing target volumes, we need to know the voxel size
-        if targetspace == 'anat0pt5':
-            voxelsize = 0.5
-            res = 512
-        elif targetspace == 'anat0pt8':
-            voxelsize = 0.8
-            res = 320
-        elif targetspace == 'anat1pt0':
-            voxelsize = 1.0
-            res = 256
-        elif targetspace == 'func1pt0':
-            voxelsize = 1.0
-            res = None
-        elif targetspace == 'func1pt8':
-            voxelsize = 1.8
-            res = None
-        elif targetspace == 'MNI':
-            voxelsize = 1
-            res = None
+        voxelsize, res = space_geometry(targetspace)
+
+        # figure out which case and load transform
+        if isinstance(targetspace, list):
+            transforms = [
+                self._get_transform(subjix, sourcespace, c_space, via, index)
+                for c_space in targetspace]
+            if any(c_case != 2 for c_case, _ in transforms):
+                raise ValueError(
+                    'multiple target spaces are only supported for '
+                    'volume-to-nativesurface mappings.')
+            casenum = 2
+            n_vertices = [a0_data.shape[0] for _, a0_data in transforms]
+            a1_data = np.vstack([a0_data for _, a0_data in transforms])
+            del transforms
         else:
-            voxelsize = None
-            res = None
-
-        # load transform
-        a1_data = load_transform(casenum, tfile)
-
-        # load sourcedata
-        sourcedata = load_sourcedata(casenum, sourcedata)
-
-        sourceclass = sourcedata.dtype
+            casenum, a1_data = self._get_transform(
+                subjix, sourcespace, targetspace, via, index)
+
+        if a1_data is None and (mask is not None or lazy):
+            raise ValueError(
+                '<mask> and <lazy> are not supported for anat-to-anat.')
+
+        if mask is not None:
+            if casenum == 4 or isinstance(targetspace, list):
+                raise ValueError(
+                    '<mask> is only supported for a single volume or '
+                    'surface target of cases 1 to 3.')
+            if outputfile is not None:
+                raise ValueError('<mask> cannot write an <outputfile>.')
+            if casenum == 1:
+                mask = _mask_indices(mask, a1_data.shape[:3])
+            else:
+                mask = _mask_indices(mask, a1_data.shape[:1])
+
+        if lazy:
+            if casenum not in (1, 2) or isinstance(targetspace, list):
+                raise ValueError(
+                    '<lazy> is only supported for volume-to-volume and '
+                    'volume-to-nativesurface mappings to a single target.')
+            if outputfile is not None:
+                raise ValueError('<lazy> cannot write an <outputfile>.')
+
+        if sink:
+            if casenum not in (1, 4) or lazy:
+                raise ValueError(
+                    '<sink> is only supported for volume-to-volume and '
+                    'nativesurface-to-volume mappings.')
+            if outputfile is None or outputfile[-4:] not in ('.nii', '.npy'):
+                raise ValueError(
+                    '<sink> needs an uncompressed .nii or .npy <outputfile>.')
+
+        if quantize is not None:
+            if casenum not in (1, 4) or isinstance(targetspace, list) or \
+                    outputfile is None or sink:
+                raise ValueError(
+                    '<quantize> needs a volume <outputfile>, without '
+                    '<sink>.')
+            if isinstance(quantize, str) and \
+                    quantize not in ('int16', 'source'):
+                raise ValueError(f'unknown quantize: {quantize}')
+            if quantize == 'source':
+                quantize = source_scaling(sourcedata)
+
+        # load sourcedata (a 4D file that goes to a process pool is read
+        # straight into shared memory, see interp_volumes_pool)
+        pooled = n_jobs not in (None, 1) and casenum in (1, 2) and \
+            a1_data is not None and not isinstance(targetspace, list)
+        sourcedata = load_sourcedata(
+            casenum, sourcedata, lazy=lazy or pooled, volumes=volumes)
+        if pooled and not lazy and not isinstance(sourcedata, np.ndarray) \
+                and len(sourcedata.shape) != 4:
+            sourcedata = np.asarray(sourcedata, dtype=np.float64)
+
+        # (files are read in double format, like get_fdata does)
+        if isinstance(sourcedata, np.ndarray):
+            sourceclass = sourcedata.dtype
+        else:
+            sourceclass = np.dtype(np.float64)
 
         # deal with outputclass
         if outputclass is None:
@@ -233,12 +626,69 @@ class NSDmapdata():
             'outputclass': outputclass,
             'voxelsize': voxelsize,
             'res': res,
-            'fsdir': fsdir}
+            'fsdir': fsdir,
+            'n_jobs': n_jobs,
+            'lazy': lazy,
+            'sink': sink,
+            'mask': mask,
+            'quantize': quantize,
+            'compresslevel': compresslevel}
 
         # apply transform
-        transformeddata = transform_data(
-            a1_data,
-            sourcedata,
-            transform_args)
+        if not isinstance(targetspace, list):
+            transformeddata = transform_data(
+                a1_data,
+                sourcedata,
+                transform_args)
+
+            if mask is not None:
+                return transformeddata, mask
+
+            return transformeddata
+
+        # multiple target surfaces: interpolate all vertices at once, and
+        # keep invalid locations as NaN until after the averaging
+        transform_args['outputfile'] = None
+        transform_args['badval'] = np.nan
+        transform_args['outputclass'] = np.result_type(sourceclass, np.float64)
+        transformeddata = np.split(
+            transform_data(a1_data, sourcedata, transform_args),
+            np.cumsum(n_vertices)[:-1])
+
+        if average:
+            if len(set(n_vertices)) > 1:
+                raise ValueError(
+                    '<average> needs surfaces with the same vertices.')
+            alldata = np.stack(transformeddata)
+            valid = np.logical_not(np.isnan(alldata))
+            alldata[np.logical_not(valid)] = 0
+            summed = np.sum(alldata, axis=0)
+            transformeddata = [zerodiv(
+                summed,
+                np.sum(valid, axis=0),
+                np.nan,
+                wantcaution=0,
+                out=summed)]
+            if outputfile is not None:
+                outputfile = [outputfile]
+
+        for data_i, data in enumerate(transformeddata):
+            data[np.isnan(data)] = badval
+            transformeddata[data_i] = data.astype(outputclass)
+
+        # if user wants files, write them out
+        if outputfile is not None:
+            if isinstance(outputfile, str) or \
+                    len(outputfile) != len(transformeddata):
+                raise ValueError(
+                    '<outputfile> needs one file per target space.')
+            if fsdir is None:
+                raise ValueError('missing argument: fsdir')
+            for data, c_file in zip(transformeddata, outputfile):
+                nsd_write_fs(
+                    data, c_file, fsdir, compresslevel=compresslevel)
+
+        if average:
+            return transformeddata[0]
 
         return transformeddata
@@ -2,25 +2,24 @@
 """
 import os
 import numpy as np
-import nibabel as nib
-import nibabel.freesurfer.mghformat as fsmgh
 
-__all__ = ["nsd_write_vol", "nsd_write_fs"]
+__all__ = ["nsd_write_vol", "nsd_create_vol", "nsd_write_fs"]
 
 
-def nsd_write_vol(data, res, outputfile, origin=None):
-    """nsd_write_vol writes volumes to disk
+def _vol_image(data, res, origin=None):
+    """build the nifti image that nsd_write_vol writes
 
     Args:
-        data (nd-array): volumetric data to write
+        data (nd-array): volumetric data (only its shape and dtype are used
+                         for the header and affine)
         res (float): data acquisition resolution (in mm)
-        outputfile (filename/path): where to save
         origin (1d-array, optional): the origin point of the volume.
                                      Defaults to None.
 
-    Raises:
-        ValueError: [description]
+    Returns:
+        [Nifti1Image]: the image, with header and affine set up.
     """
+    import nibabel as nib
 
     data_class = data.dtype
 
@@ -31,35 +30,215 @@ def nsd_write_vol(data, res, outputfile, origin=None):
     # affine
     affine = np.diag([res]*3 + [1])
     if origin is None:
-        origin = (([1, 1, 1] + np.asarray(data.shape))/2)-1
+        origin = (([1, 1, 1] + np.asarray(data.shape[:3]))/2)-1
 
     affine[0, -1] = -origin[0]*res
     affine[1, -1] = -origin[1]*res
     affine[2, -1] = -origin[2]*res
 
-    # write the nifti volume
-    img = nib.Nifti1Image(
+    return nib.Nifti1Image(
         data,
         affine,
         header)
 
-    img.to_filename(outputfile)
 
+def _quantize(data, dtype=np.int16, scaling=None):
+    """integers <raw> such that raw * slope + inter approximates <data>
+
+    Args:
+        data (nd-array): the data to quantize
+        dtype (dtype, optional): the integer type. Defaults to np.int16.
+        scaling (tuple, optional): the (slope, inter) to use. Defaults to
+                    None, which chooses them from the range of the data:
+                    if the range includes 0, inter is 0 (so that 0, e.g.
+                    the badval of mapped volumes, stays exact), otherwise
+                    it is the middle of the range, and slope is the
+                    smallest step that covers the range.
+
+    Returns:
+        raw (nd-array): the quantized data. Values outside of the range of
+                    <scaling> are clipped, and non-finite values become 0.
+        slope, inter (float): the scaling. Every finite value in range is
+                    within slope/2 of its quantized value.
+    """
+    info = np.iinfo(dtype)
+    finite = np.isfinite(data)
+
+    if scaling is None:
+        # (non-finite values become 0, so 0 must be in range then)
+        lo = np.min(data, initial=0 if not np.all(finite) else np.inf,
+                    where=finite)
+        hi = np.max(data, initial=0 if not np.all(finite) else -np.inf,
+                    where=finite)
+
+        # the header stores the scaling in float32: round inter first, and
+        # the slope up, so that the range stays covered
+        inter = np.float32(0 if lo <= 0 <= hi else (lo + hi)/2)
+        slope = max((lo - inter)/info.min, (hi - inter)/info.max)
+        slope32 = np.float32(slope)
+        if slope32 < slope:
+            slope32 = np.nextafter(slope32, np.float32(np.inf))
+        scaling = (slope32 if slope32 > 0 else 1.0, inter)
+
+    slope, inter = (float(c) for c in scaling)
+
+    raw = np.where(finite, data, 0) - inter
+    raw /= slope
+    np.rint(raw, out=raw)
+    np.clip(raw, info.min, info.max, out=raw)
+
+    return raw.astype(dtype), float(slope), float(inter)
+
+
+def nsd_write_vol(data, res, outputfile, origin=None, quantize=None):
+    """nsd_write_vol writes volumes to disk
+
+    Args:
+        data (nd-array): volumetric data to write
+        res (float): data acquisition resolution (in mm)
+        outputfile (filename/path): where to save
+        origin (1d-array, optional): the origin point of the volume.
+                                     Defaults to None.
+        quantize (optional): None to store <data> in its own type, 'int16'
+                             to store it as int16 with a scl_slope and
+                             scl_inter chosen from its range, or a (slope,
+                             inter) tuple to store it as int16 with this
+                             scaling (e.g. that of the source file). See
+                             _quantize for the precision. Defaults to None.
+
+    Raises:
+        ValueError: [description]
+    """
+    if quantize is None:
+        # write the nifti volume
+        img = _vol_image(data, res, origin=origin)
+
+        img.to_filename(outputfile)
+        return
+
+    from nibabel.openers import ImageOpener
 
-def nsd_write_fs(data, outputfile, fsdir):
+    scaling = None if quantize == 'int16' else quantize
+    raw, slope, inter = _quantize(data, np.int16, scaling)
+
+    # nibabel recomputes the scaling of the data it writes, so write the
+    # header (with our scaling) and the raw data ourselves
+    img = _vol_image(raw, res, origin=origin)
+    img.update_header()
+    header = img.header
+    header.set_slope_inter(slope, inter)
+    with ImageOpener(outputfile, 'wb') as fileobj:
+        header.write_to(fileobj)
+        offset = int(header.get_data_offset())
+        fileobj.write(b'\x00' * (offset - fileobj.tell()))
+        fileobj.write(raw.tobytes(order='F'))
+
+
+def nsd_create_vol(shape, dtype, res, outputfile, origin=None):
+    """nsd_create_vol preallocates a volume file on disk for writing
+
+    The file gets the same header and affine as nsd_write_vol would give
+    it, and the (zero-filled) data are returned as a memory-mapped array,
+    so that volumes can be written straight into the file one at a time.
+
+    Args:
+        shape (tuple): X x Y x Z (x D) shape of the data
+        dtype (dtype): data class to store
+        res (float): data acquisition resolution (in mm)
+        outputfile (filename/path): an uncompressed .nii file, or a .npy
+                                    file (which has no header or affine)
+        origin (1d-array, optional): the origin point of the volume.
+                                     Defaults to None.
+
+    Raises:
+        ValueError: if <outputfile> is not a .nii or .npy file.
+
+    Returns:
+        [np.memmap]: writable view of the data in the file (in fortran
+                     order, like the nifti format).
+    """
+    if outputfile[-4:] == '.npy':
+        return np.lib.format.open_memmap(
+            outputfile,
+            mode='w+',
+            dtype=dtype,
+            shape=tuple(shape),
+            fortran_order=True)
+
+    if outputfile[-4:] != '.nii':
+        raise ValueError(
+            'can only preallocate uncompressed .nii or .npy files.')
+
+    # header and affine as in nsd_write_vol (with a placeholder that has
+    # the right shape and dtype but no memory)
+    img = _vol_image(
+        np.broadcast_to(np.zeros((), dtype=dtype), tuple(shape)),
+        res,
+        origin=origin)
+    img.update_header()
+    header = img.header
+
+    # write the header and grow the file to its full size
+    with open(outputfile, 'wb') as fileobj:
+        header.write_to(fileobj)
+        offset = int(header.get_data_offset())
+        fileobj.write(b'\x00' * (offset - fileobj.tell()))
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        fileobj.truncate(offset + nbytes)
+
+    return np.memmap(
+        outputfile,
+        dtype=header.get_data_dtype(),
+        mode='r+',
+        offset=offset,
+        shape=tuple(shape),
+        order='F')
+
+
+def _mgh_dtype(data):
+    """the MGH data type (uint8, int16, int32 or float32) closest to <data>
+
+    Integers keep their type if MGH has it, or are widened to int32 if
+    their values fit (float32 otherwise); everything else is stored as
+    float32, since MGH has no float64.
+    """
+    dtype = np.dtype(data.dtype)
+    if dtype == np.bool_:
+        return np.dtype(np.uint8)
+    if dtype in (np.uint8, np.int16, np.int32, np.float32):
+        return dtype
+    if dtype.kind in 'iu':
+        info = np.iinfo(np.int32)
+        if data.size == 0 or (
+                np.min(data) >= info.min and np.max(data) <= info.max):
+            return np.dtype(np.int32)
+
+    return np.dtype(np.float32)
+
+
+def nsd_write_fs(data, outputfile, fsdir, compresslevel=1):
     """similar to nsd_vrite_vol but for surface mgz
 
     Args:
-        data (nd-array): the surface data
+        data (nd-array): the surface data, V (vertices) or V x D, in which
+                         case the D datasets are written as the frames of
+                         one file (V x 1 x 1 x D).
         outputfile (filename/path): where to save
         fsdir (path): we need to know where the fsdir is.
+        compresslevel (int, optional): gzip compression level (1-9) for
+                         .mgz files; higher levels make smaller files, but
+                         take longer to write. Defaults to 1.
 
     Raises:
         ValueError: if wrong file name provided, e.g doesn't have
                     lh or rh in filename, error is raised.
+
+    The data are stored in their own type if MGH supports it (uint8,
+    int16, int32 or float32), see _mgh_dtype.
     """
+    import nibabel.freesurfer.mghformat as fsmgh
+    from nibabel.openers import ImageOpener
 
-    # load template
     # load template
     if outputfile.find('lh.') != -1:
         hemi = 'lh'
@@ -78,8 +257,20 @@ def nsd_write_fs(data, outputfile, fsdir):
     header = img.header
     affine = img.affine
 
-    # Okay, make a new object now...
-    vol_h = data[:, np.newaxis].astype(np.float64)
+    # Okay, make a new object now (one frame per dataset)...
+    data = np.asarray(data)
+    if data.ndim == 2 and data.shape[1] == 1:
+        # (MGH wants V x 1 x 1 for a single frame, not V x 1 x 1 x 1)
+        data = data[:, 0]
+    dtype = _mgh_dtype(data)
+    vol_h = data.reshape(
+        (data.shape[0], 1, 1) + data.shape[1:]).astype(dtype, copy=False)
     v_img = fsmgh.MGHImage(vol_h, affine, header=header, extra={})
+    v_img.set_data_dtype(dtype)
 
-    v_img.to_filename(outputfile)
+    if outputfile.endswith('.mgz'):
+        with ImageOpener(
+                outputfile, 'wb', compresslevel=compresslevel) as fobj:
+            v_img.to_stream(fobj)
+    else:
+        v_img.to_filename(outputfile)
@@ -0,0 +1,213 @@
+"""nsd_scheduler
+"""
+import os
+import queue
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Manager
+import numpy as np
+from nsdcode.nsd_mapdata import NSDmapdata
+from nsdcode.parse_case import parse_case
+from nsdcode.transform_index import TransformIndex
+
+__all__ = ["nsd_scheduler"]
+
+
+def _job_cost(index, job):
+    """estimate the cost of a fit job as target locations x volumes
+
+    Args:
+        index (TransformIndex): the transforms of the job's subject
+        job (dict): keyword arguments for NSDmapdata.fit
+
+    Returns:
+        [float]: the estimated cost. Only the source file header is read
+                 (the transform shapes come from <index>); if the cost
+                 cannot be estimated, it falls back to 1.
+    """
+    import nibabel as nib
+
+    try:
+        # number of datasets (volumes or surface vectors)
+        sourcedata = job['sourcedata']
+        if isinstance(sourcedata, str):
+            shape = nib.load(sourcedata).shape
+        elif isinstance(sourcedata, list):
+            shape = np.shape(sourcedata[0])
+        else:
+            shape = np.shape(sourcedata)
+        n_datasets = shape[-1] if len(shape) in (2, 4) else 1
+
+        # number of target locations
+        targetspaces = job['targetspace']
+        if not isinstance(targetspaces, list):
+            targetspaces = [targetspaces]
+        sourcespace = job['sourcespace']
+        via = job.get('via')
+        if via is not None:
+            sourcespace = via if isinstance(via, str) else via[-1]
+
+        n_points = 0
+        for targetspace in targetspaces:
+            casenum, tfile = parse_case(sourcespace, targetspace, index.tdir)
+            if tfile is None:
+                # anat-to-anat
+                n_points += np.prod(index.space_shape(targetspace))
+                continue
+            for c_file in (tfile if isinstance(tfile, list) else [tfile]):
+                tshape = index.header(c_file)[0]
+                if casenum == 1:
+                    n_points += np.prod(tshape[:3])
+                else:
+                    n_points += tshape[0]
+
+        return float(n_points) * n_datasets
+
+    except Exception:
+        return 1.0
+
+
+def _run_subject(base_dir, subjix, subjobs, progress, return_data,
+                 compact_transforms=None):
+    """run the jobs of one subject, one after the other
+
+    The subject gets its own NSDmapdata with a transform cache. ('start',
+    subjix) is put on <progress> first, then ('done', job_i) after every
+    job.
+    """
+    progress.put(('start', subjix))
+    nsd = NSDmapdata(
+        base_dir,
+        cache_transforms=True,
+        compact_transforms=compact_transforms)
+
+    results = {}
+    errors = {}
+    for job_i, job in subjobs:
+        try:
+            transformeddata = nsd.fit(**job)
+            results[job_i] = transformeddata if return_data else None
+        except Exception:
+            errors[job_i] = traceback.format_exc()
+        progress.put(('done', job_i))
+
+    return results, errors
+
+
+def nsd_scheduler(base_dir, jobs, n_workers=None, return_data=True,
+                  compact_transforms=None):
+    """run many NSDmapdata.fit jobs for several subjects in parallel
+
+    Jobs are grouped by subject, and all jobs of a subject run in the same
+    worker process, one after the other, sharing one transform cache (see
+    NSDmapdata(cache_transforms=True)), so every transform is loaded once.
+    The subjects are handed to the workers largest first, by their
+    estimated cost (target locations x volumes, read from the file
+    headers, with one scan of the transforms directory per subject), and
+    each idle worker takes the next one.
+
+    If a worker process dies (e.g. it is killed for running out of
+    memory), the jobs of the subjects it was running are recorded as
+    failed, the pool is rebuilt, and the subjects that had not started yet
+    are run in the new pool. The results of finished subjects are kept.
+
+    Args:
+        base_dir (path): directory where the nsd_data lives
+        jobs (list): one dict of keyword arguments for NSDmapdata.fit per
+                     job, e.g. dict(subjix=1, sourcespace='func1pt8',
+                     targetspace='MNI', sourcedata=..., outputfile=...).
+        n_workers (int, optional): number of worker processes. Defaults to
+                     the number of subjects or the number of cpus,
+                     whichever is smaller.
+        return_data (bool, optional): whether to send the mapped data back
+                     from the workers. Set this to False when every job
+                     writes an <outputfile>. Defaults to True.
+        compact_transforms (dtype, optional): see NSDmapdata. Defaults to
+                     None.
+
+    Returns:
+        results (list): the output of fit for each job (None for failed
+                        jobs, or for all jobs if not <return_data>).
+        errors (dict): job index -> traceback of the failed jobs.
+    """
+    from tqdm import tqdm
+
+    # group jobs by subject
+    bysubject = {}
+    for job_i, job in enumerate(jobs):
+        bysubject.setdefault(job['subjix'], []).append((job_i, job))
+
+    if n_workers is None:
+        n_workers = min(len(bysubject), os.cpu_count())
+    n_workers = max(1, min(n_workers, len(bysubject)))
+
+    # hand out the largest subjects first (longest processing time first)
+    costs = {}
+    for subjix, subjobs in bysubject.items():
+        index = TransformIndex.for_subject(base_dir, subjix)
+        costs[subjix] = sum(_job_cost(index, job) for _, job in subjobs)
+    todo = sorted(costs, key=costs.get, reverse=True)
+
+    results = [None] * len(jobs)
+    errors = {}
+    with Manager() as manager, tqdm(total=len(jobs), desc='jobs') as pbar:
+        progress = manager.Queue()
+        started = set()
+
+        def drain():
+            """aggregate the progress messages of the workers"""
+            while True:
+                try:
+                    kind, value = progress.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == 'start':
+                    started.add(value)
+                else:
+                    pbar.update(1)
+
+        while todo:
+            broken = []
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                subjects = {
+                    pool.submit(
+                        _run_subject, base_dir, subjix, bysubject[subjix],
+                        progress, return_data, compact_transforms): subjix
+                    for subjix in todo}
+                pending = set(subjects)
+                while pending:
+                    done, pending = wait(
+                        pending, timeout=1, return_when=FIRST_COMPLETED)
+                    drain()
+
+                    # aggregate results and failures
+                    for future in done:
+                        try:
+                            c_results, c_errors = future.result()
+                        except BrokenProcessPool:
+                            broken.append(subjects[future])
+                            continue
+                        for job_i, transformeddata in c_results.items():
+                            results[job_i] = transformeddata
+                        errors.update(c_errors)
+                        pbar.set_postfix(failed=len(errors))
+            drain()
+
+            # the subjects that were running when a worker died fail,
+            # the others are run again in a new pool (all of them fail if
+            # none had started, so that this always ends)
+            todo = [subjix for subjix in broken if subjix not in started]
+            if len(todo) == len(broken):
+                todo = []
+            for subjix in broken:
+                if subjix in todo:
+                    continue
+                for job_i, _ in bysubject[subjix]:
+                    errors[job_i] = (
+                        f'BrokenProcessPool: the worker process running '
+                        f'subject {subjix} died (e.g. it ran out of '
+                        f'memory).')
+            pbar.set_postfix(failed=len(errors))
+
+    return results, errors
@@ -18,6 +18,7 @@ def parse_case(sourcespace, targetspace, tdir):
 
     Returns:
         [int]: which case we are in.
+        tfile: the transform file(s) (None for anat-to-anat).
     """
     hemi = None
 
@@ -39,8 +40,12 @@ def parse_case(sourcespace, targetspace, tdir):
 
     # deal with basic setup
     if casenum == 1:
-        tfile = os.path.join(f'{tdir}',
-                             f'{sourcespace}-to-{targetspace}.nii.gz')
+        if sourcespace[:4] == 'anat' and targetspace[:4] == 'anat':
+            # anat-to-anat does not have files (resampled analytically)
+            tfile = None
+        else:
+            tfile = os.path.join(f'{tdir}',
+                                 f'{sourcespace}-to-{targetspace}.nii.gz')
     elif casenum in (2, 3):
         if targetspace[:3] == 'lh.' or targetspace[:3] == 'rh.':
             hemi = targetspace[:3]
@@ -0,0 +1,171 @@
+"""results_cache
+"""
+import os
+import json
+import shutil
+import hashlib
+import uuid
+import numpy as np
+
+__all__ = ["ResultsCache"]
+
+
+# bump this when a change to the mapping code changes its results
+CACHE_VERSION = 1
+
+
+class ResultsCache():
+    """content-addressed on-disk cache of NSDmapdata.fit results
+
+    Every result is stored under a hash of everything it depends on: the
+    fit arguments, the identity (path, size and modification time) of the
+    source and transform files, and the content of source arrays. Results
+    are kept as uncompressed .npy files, which are memory-mapped
+    (copy-on-write) when they are read back, so a hit costs next to
+    nothing. When the cache grows beyond <max_bytes>, the least recently
+    used results are deleted.
+
+    Attributes:
+        cache_dir (path): where the results are kept.
+        max_bytes (int): the disk budget.
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2**30):
+        """open (or create) a results cache in <cache_dir>
+
+        Args:
+            cache_dir (path): where to keep the results (created if needed).
+            max_bytes (int, optional): the disk budget. Defaults to 10 GB.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def identity(obj):
+        """a hashable description of a source, transform or argument
+
+        Args:
+            obj: a file name (described by its absolute path, size and
+                 modification time), an array (described by its shape,
+                 dtype and a hash of its content), a list or tuple of
+                 these, a dtype, or a plain value (None, bool, number or
+                 string).
+
+        Returns:
+            [str or tuple]: the description.
+
+        Raises:
+            TypeError: for anything else, whose content cannot be told
+                 from its repr (e.g. a nibabel image).
+        """
+        if isinstance(obj, (list, tuple)):
+            return tuple(ResultsCache.identity(item) for item in obj)
+        if isinstance(obj, str) and os.path.isfile(obj):
+            stat = os.stat(obj)
+            return (os.path.abspath(obj), stat.st_size, stat.st_mtime_ns)
+        if isinstance(obj, np.ndarray):
+            digest = hashlib.blake2b(digest_size=20)
+            digest.update(np.ascontiguousarray(obj).view(np.uint8).data)
+            return (obj.shape, obj.dtype.str, digest.hexdigest())
+        if isinstance(obj, (np.dtype, type)):
+            return np.dtype(obj).str
+        if obj is None or isinstance(obj, (bool, int, float, str, np.generic)):
+            return repr(obj)
+
+        raise TypeError(f'cannot cache results for {type(obj).__name__}.')
+
+    def key(self, *parts):
+        """the cache key (a hex digest) of a list of parts (see identity)"""
+        description = repr((CACHE_VERSION, self.identity(parts)))
+
+        return hashlib.blake2b(
+            description.encode(), digest_size=20).hexdigest()
+
+    def _entries(self):
+        """(last use, size, path) of every stored result"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            meta = os.path.join(path, 'meta.json')
+            if name.startswith('.') or not os.path.isfile(meta):
+                continue
+            size = sum(
+                entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(meta).st_mtime_ns, size, path))
+
+        return entries
+
+    def get(self, key):
+        """the stored result for <key>, or None
+
+        The arrays are memory-mapped copy-on-write: they can be modified
+        in memory, but the stored result stays the same.
+        """
+        path = os.path.join(self.cache_dir, key)
+        meta = os.path.join(path, 'meta.json')
+        try:
+            with open(meta) as meta_file:
+                info = json.load(meta_file)
+            arrays = [
+                np.asarray(np.load(
+                    os.path.join(path, f'{array_i}.npy'), mmap_mode='c'))
+                for array_i in range(info['n_arrays'])]
+            os.utime(meta)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if info['kind'] == 'array':
+            return arrays[0]
+        if info['kind'] == 'tuple':
+            return tuple(arrays)
+
+        return arrays
+
+    def put(self, key, result):
+        """store a result (an array, or a list or tuple of arrays)
+
+        Results that are larger than the whole budget are not stored.
+        """
+        if isinstance(result, np.ndarray):
+            kind, arrays = 'array', [result]
+        elif isinstance(result, (list, tuple)) and all(
+                isinstance(array, np.ndarray) for array in result):
+            kind = 'tuple' if isinstance(result, tuple) else 'list'
+            arrays = list(result)
+        else:
+            return
+        if sum(array.nbytes for array in arrays) > self.max_bytes:
+            return
+
+        # write to a scratch directory, then move it in place in one go
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = os.path.join(self.cache_dir, f'.{key}.{uuid.uuid4().hex}')
+        os.makedirs(tmp_path)
+        try:
+            for array_i, array in enumerate(arrays):
+                np.save(os.path.join(tmp_path, f'{array_i}.npy'), array)
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+                json.dump({'kind': kind, 'n_arrays': len(arrays)}, meta_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            # (e.g. another process stored the same result first)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """delete the least recently used results beyond the disk budget"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """delete every stored result"""
+        for _, _, path in self._entries():
+            shutil.rmtree(path, ignore_errors=True)
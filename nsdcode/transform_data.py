@@ -1,21 +1,152 @@
 """transform_data
 """
 import numpy as np
-from nsdcode.nsd_output import nsd_write_vol, nsd_write_fs
-from nsdcode.interp_wrapper import interp_wrapper as iw
+from nsdcode.nsd_output import nsd_write_vol, nsd_create_vol, nsd_write_fs
+from nsdcode.interp_wrapper import interp_prepare, interp_wrapper as iw
+from nsdcode.interp_pool import interp_volumes_pool
 from nsdcode.mapsurfacetovolume import mapsurfacetovolume
-from tqdm import tqdm
+from nsdcode.changevolumeres import changevolumeres
+from nsdcode.mapped_array import MappedArray
+from nsdcode.compact_field import CompactField
 
 
 __all__ = ['transform_data']
 
 
+def _map_volumes(sourcedata, plan, tr_args, out=None):
+    """interpolate one volume (X x Y x Z) or a stack (X x Y x Z x D)
+
+    Args:
+        sourcedata (nd-array): the source volume(s).
+        plan (dict): output of interp_prepare for the target coordinates.
+        tr_args (dict): see transform_data.
+        out (nd-array, optional): N or N x D array to write the results
+                                  into (e.g. a view of a memory-mapped
+                                  output file). Defaults to None.
+
+    Returns:
+        [nd-array]: N (3D source) or N x D (4D source) data in
+                    <outputclass>, with invalid locations set to <badval>.
+    """
+    from tqdm import tqdm
+
+    interptype = tr_args['interptype']
+    badval = tr_args['badval']
+    outputclass = tr_args['outputclass']
+
+    if sourcedata.ndim == 3:
+        transformeddata = iw(
+            sourcedata, None, interptype=interptype, plan=plan)
+        transformeddata[np.isnan(transformeddata)] = badval
+        if out is not None:
+            out[...] = transformeddata
+            return out
+
+        return transformeddata.astype(outputclass)
+
+    # if a stack is passed, we can farm the volumes out to a process pool
+    n_jobs = tr_args.get('n_jobs')
+    if n_jobs is not None and n_jobs != 1:
+        return interp_volumes_pool(
+            sourcedata,
+            plan,
+            interptype,
+            outputclass,
+            badval,
+            n_jobs=n_jobs,
+            out=out)
+
+    n_vols = sourcedata.shape[-1]
+    if out is None:
+        out = np.empty(
+            (plan['bad'].size, n_vols), dtype=outputclass, order='F')
+
+    # cubic convolution maps several volumes per pass (sharing the taps)
+    if interptype == 'cubicconv':
+        step = 16
+        for start in tqdm(range(0, n_vols, step), desc='volumes'):
+            vol_is = slice(start, start + step)
+            tmp = iw(
+                sourcedata[..., vol_is],
+                None,
+                interptype=interptype,
+                plan=plan)
+            tmp[np.isnan(tmp)] = badval
+            out[:, vol_is] = tmp
+
+        return out
+
+    for vol_i in tqdm(range(n_vols), desc='volumes'):
+        tmp = iw(
+            sourcedata[..., vol_i],
+            None,
+            interptype=interptype,
+            plan=plan)
+        tmp[np.isnan(tmp)] = badval
+        out[:, vol_i] = tmp
+
+    return out
+
+
+def _map_anat(sourcedata, tr_args):
+    """resample anat volume(s) to another anat resolution (no transform)
+
+    Args:
+        sourcedata (nd-array): X x Y x Z (x D) source volume(s).
+        tr_args (dict): see transform_data (uses 'interptype', 'res',
+                        'voxelsize', 'outputclass', 'outputfile' and
+                        'sink').
+
+    Returns:
+        [nd-array]: res x res x res (x D) data in <outputclass> (a
+                    memory-mapped view of <outputfile> if <sink>).
+    """
+    from tqdm import tqdm
+
+    targetshape = (tr_args['res'],) * 3
+    wantlabel = tr_args['interptype'] == 'wta'
+    origin = (([1, 1, 1] + np.asarray(targetshape))/2)-1
+
+    outshape = targetshape + sourcedata.shape[3:]
+    if tr_args.get('sink'):
+        transformeddata = nsd_create_vol(
+            outshape,
+            tr_args['outputclass'],
+            tr_args['voxelsize'],
+            tr_args['outputfile'],
+            origin=origin)
+    else:
+        transformeddata = np.empty(outshape, dtype=tr_args['outputclass'])
+
+    if sourcedata.ndim == 3:
+        transformeddata[...] = changevolumeres(
+            sourcedata, targetshape, wantlabel)
+    else:
+        for vol_i in tqdm(range(sourcedata.shape[3]), desc='volumes'):
+            transformeddata[..., vol_i] = changevolumeres(
+                sourcedata[..., vol_i], targetshape, wantlabel)
+
+    if tr_args.get('sink'):
+        transformeddata.flush()
+    elif tr_args['outputfile'] is not None:
+        nsd_write_vol(
+            transformeddata,
+            tr_args['voxelsize'],
+            tr_args['outputfile'],
+            origin=origin,
+            quantize=tr_args.get('quantize'))
+
+    return transformeddata
+
+
 def transform_data(a1_data, sourcedata, tr_args):
     """transform_data
 
     Args:
         casenum (int): which case
-        a1_data (nd-array): transformation map
+        a1_data (nd-array): transformation map (None for anat-to-anat,
+            which is resampled analytically; a CompactField for a compact
+            case-1 transform)
         sourcedata (nd-array): data to be interpolated into target space
         tr_args (dict):
             casenum = tr_args['casenum']
@@ -27,79 +158,117 @@ def transform_data(a1_data, sourcedata, tr_args):
             outputclass = tr_args['outputclass']
             badval = tr_args['badval']
             fsdir = tr_args['fsdir']
+            n_jobs = tr_args['n_jobs'] (optional, cases 1 and 2 with
+                a 4D source: number of worker processes)
+            lazy = tr_args['lazy'] (optional, cases 1 and 2: return a
+                MappedArray instead of computing the data)
+            sink = tr_args['sink'] (optional, cases 1 and 4: preallocate
+                <outputfile> and write each volume straight into it)
+            mask = tr_args['mask'] (optional, cases 1 to 3: 0-based
+                indices of the target locations to compute, in fortran
+                order for volumes; the output is then ROI x D)
+            quantize = tr_args['quantize'] (optional, cases 1 and 4:
+                store <outputfile> as int16, see nsd_write_vol)
+            compresslevel = tr_args['compresslevel'] (optional, cases 2
+                and 3: gzip level of a .mgz <outputfile>, see nsd_write_fs)
 
     """
     # figure out if we have a 4d nifti as source
     n_dims = sourcedata.ndim
 
     # do it
-    if tr_args['casenum'] == 1:    # volume-to-volume
-
-        xdim, ydim, zdim, _ = a1_data.shape
-        targetshape = (xdim, ydim, zdim)
-
-        # construct coordinates
-        coords = np.c_[a1_data[:, :, :, 0].ravel(order='F'),
-                       a1_data[:, :, :, 1].ravel(order='F'),
-                       a1_data[:, :, :, 2].ravel(order='F')].T
+    if tr_args['casenum'] == 1 and a1_data is None:    # anat-to-anat
+        return _map_anat(sourcedata, tr_args)
 
-        # ensure that 9999 locations will propagate as NaN
-        coords[coords == 9999] = np.nan
-        coords = coords - 1  # coords is based on Kendrick's 1-based indexing.
-
-        if n_dims == 4:
-            # if a stack is passed
-            transformeddata = []
-
-            sourcedata = np.moveaxis(sourcedata, -1, 0)
-
-            for sdata in tqdm(sourcedata, desc='volumes'):
-                tmp = iw(
-                    sdata,
-                    coords,
-                    interptype=tr_args['interptype']).astype(
-                        tr_args['outputclass'])
-
-                tmp[np.isnan(tmp)] = tr_args['badval']
-                tmp = np.reshape(tmp, targetshape, order='F')
-                transformeddata.append(tmp)
+    if tr_args['casenum'] == 1:    # volume-to-volume
 
-            # reshape as a 4d volume
-            transformeddata = np.moveaxis(np.asarray(transformeddata), 0, -1)
+        if tr_args.get('mask') is None:
+            xdim, ydim, zdim, _ = a1_data.shape
+            targetshape = (xdim, ydim, zdim)
         else:
-
-            transformeddata = iw(
-                sourcedata,
-                coords,
-                interptype=tr_args['interptype']).astype(
-                    tr_args['outputclass'])
-
-            transformeddata[np.isnan(transformeddata)] = tr_args['badval']
-            transformeddata = np.reshape(
-                transformeddata,
-                targetshape,
-                order='F')
-
-        # if user wants a file, write it out
+            # only keep the target voxels in the mask
+            a1_data = a1_data.reshape([-1, 1, 1, 3], order='F')[
+                tr_args['mask']]
+            targetshape = (a1_data.shape[0],)
+
+        # In the case of the target being MNI, we write out LPI niftis.
+        # flipping the first dimension of the target grid is the same as
+        # flipping the mapped data.
         if tr_args['outputfile'] is not None:
             if tr_args['targetspace'] == 'MNI':
                 print('saving image in MNI space')
 
-                transformeddata = np.flip(transformeddata, axis=0)
+                a1_data = a1_data[::-1]
                 origin = np.asarray([183-91, 127, 73]) - 1  # consider -1 here.
 
             else:
-                origin = \
-                    (([1, 1, 1] + np.asarray(transformeddata.shape[:3]))/2)-1
+                origin = (([1, 1, 1] + np.asarray(targetshape))/2)-1
 
+        # construct coordinates
+        if isinstance(a1_data, CompactField):
+            # decoded block by block (9999 locations are NaN, 0-based)
+            coords = a1_data.coords()
+        else:
+            coords = np.c_[a1_data[:, :, :, 0].ravel(order='F'),
+                           a1_data[:, :, :, 1].ravel(order='F'),
+                           a1_data[:, :, :, 2].ravel(order='F')].T
+
+            # ensure that 9999 locations will propagate as NaN
+            coords[coords == 9999] = np.nan
+            # coords is based on Kendrick's 1-based indexing.
+            coords = coords - 1
+
+        plan = interp_prepare(
+            coords,
+            sourcedata.shape,
+            copy=False,
+            interptype=tr_args['interptype'])
+        if tr_args.get('lazy'):
+            return MappedArray(sourcedata, plan, targetshape, tr_args)
+
+        # write each volume straight into a preallocated output file
+        if tr_args.get('sink'):
+            transformeddata = nsd_create_vol(
+                targetshape + sourcedata.shape[3:],
+                tr_args['outputclass'],
+                tr_args['voxelsize'],
+                tr_args['outputfile'],
+                origin=origin)
+            _map_volumes(
+                sourcedata,
+                plan,
+                tr_args,
+                out=np.reshape(
+                    transformeddata,
+                    (coords.shape[1],) + sourcedata.shape[3:],
+                    order='F'))
+            transformeddata.flush()
+
+            return transformeddata
+
+        transformeddata = _map_volumes(sourcedata, plan, tr_args)
+
+        # reshape as a 3d or 4d volume
+        transformeddata = np.reshape(
+            transformeddata,
+            targetshape + transformeddata.shape[1:],
+            order='F')
+
+        # if user wants a file, write it out
+        if tr_args['outputfile'] is not None:
             nsd_write_vol(
                 transformeddata,
                 tr_args['voxelsize'],
                 tr_args['outputfile'],
-                origin=origin)
+                origin=origin,
+                quantize=tr_args.get('quantize'))
 
     elif tr_args['casenum'] == 2:    # volume-to-nativesurface
 
+        # only keep the target vertices in the mask
+        if tr_args.get('mask') is not None:
+            a1_data = a1_data[tr_args['mask']]
+
         # construct coordinates
         coords = np.c_[a1_data[:, 0].ravel(order='F'),
                        a1_data[:, 1].ravel(order='F'),
@@ -109,30 +278,16 @@ def transform_data(a1_data, sourcedata, tr_args):
         # coords is based on Kendrick's 1-based indexing.
         coords = coords - 1
 
-        if n_dims == 4:
-            transformeddata = []
-
-            sourcedata = np.moveaxis(sourcedata, -1, 0)
-            for sdata in tqdm(sourcedata, desc='volumes'):
-                tmp = iw(
-                    sdata,
-                    coords,
-                    interptype=tr_args['interptype']).astype(
-                        tr_args['outputclass'])
+        plan = interp_prepare(
+            coords,
+            sourcedata.shape,
+            copy=False,
+            interptype=tr_args['interptype'])
+        if tr_args.get('lazy'):
+            return MappedArray(
+                sourcedata, plan, (coords.shape[1],), tr_args)
 
-                tmp[np.isnan(tmp)] = tr_args['badval']
-                transformeddata.append(tmp)
-
-            # reshape as a n-dim volume
-            transformeddata = np.moveaxis(np.asarray(transformeddata), 0, -1)
-        else:
-            transformeddata = iw(
-                sourcedata,
-                coords,
-                interptype=tr_args['interptype']).astype(
-                    tr_args['outputclass'])
-
-            transformeddata[np.isnan(transformeddata)] = tr_args['badval']
+        transformeddata = _map_volumes(sourcedata, plan, tr_args)
 
         # if user wants a file, write it out
         if tr_args['outputfile'] is not None:
@@ -143,20 +298,24 @@ def transform_data(a1_data, sourcedata, tr_args):
             nsd_write_fs(
                 transformeddata,
                 tr_args['outputfile'],
-                tr_args['fsdir'])
+                tr_args['fsdir'],
+                compresslevel=tr_args.get('compresslevel', 1))
 
     # nativesurface-to-fsaverage  or  fsaverage-to-nativesurface
     elif tr_args['casenum'] == 3:
 
+        # only keep the target vertices in the mask
+        if tr_args.get('mask') is not None:
+            a1_data = a1_data[tr_args['mask']]
+
         # use nearest-neighbor and set the output class
+        vertices = np.squeeze(a1_data.astype(int), axis=1) - 1
         if n_dims == 1:
-            transformeddata = \
-                sourcedata[np.squeeze(a1_data.astype(int)) - 1].astype(
-                    tr_args['outputclass'])
+            transformeddata = sourcedata[vertices].astype(
+                tr_args['outputclass'])
         elif n_dims > 1:
-            transformeddata = \
-                sourcedata[np.squeeze(a1_data.astype(int)) - 1, :].astype(
-                    tr_args['outputclass'])
+            transformeddata = sourcedata[vertices, :].astype(
+                tr_args['outputclass'])
         # matlab based indexing in a1_data: 0-based in python
 
         # if user wants a file, write it out
@@ -168,29 +327,46 @@ def transform_data(a1_data, sourcedata, tr_args):
             nsd_write_fs(
                 transformeddata,
                 tr_args['outputfile'],
-                tr_args['fsdir'])
+                tr_args['fsdir'],
+                compresslevel=tr_args.get('compresslevel', 1))
 
     elif tr_args['casenum'] == 4:
         specialcase = 0
         if tr_args['interptype'] == 'surfacewta':
             specialcase = 1
-        transformeddata = mapsurfacetovolume(
+
+        # V x D source: map the datasets in blocks, straight into the
+        # output (or a preallocated output file)
+        sourcedata = sourcedata.reshape(sourcedata.shape[0], -1)
+        n_datasets = sourcedata.shape[1]
+        targetshape = (tr_args['res'],) * 3
+        outshape = targetshape + ((n_datasets,) if n_datasets > 1 else ())
+        if tr_args.get('sink'):
+            transformeddata = nsd_create_vol(
+                outshape,
+                tr_args['outputclass'],
+                tr_args['voxelsize'],
+                tr_args['outputfile'])
+        else:
+            transformeddata = np.empty(
+                outshape, dtype=tr_args['outputclass'], order='F')
+
+        mapsurfacetovolume(
             sourcedata.T,
             a1_data.T,
             tr_args['res'],
             specialcase,
-            tr_args['badval']
-        )
-
-        # reshape as a n-dim volume
-        transformeddata = np.moveaxis(np.asarray(transformeddata), 0, -1).squeeze()
+            tr_args['badval'],
+            out=transformeddata.reshape(targetshape + (-1,), order='F'))
 
-        # if user wants a file, write it out
-        if tr_args['outputfile'] is not None:
+        if tr_args.get('sink'):
+            transformeddata.flush()
+        elif tr_args['outputfile'] is not None:
+            # if user wants a file, write it out
             nsd_write_vol(
                 transformeddata,
                 tr_args['voxelsize'],
-                tr_args['outputfile']
-                )
+                tr_args['outputfile'],
+                quantize=tr_args.get('quantize'))
 
     return transformeddata
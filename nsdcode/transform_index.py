@@ -0,0 +1,164 @@
+"""transform_index
+"""
+import os
+from nsdcode.nsd_datalocation import nsd_datalocation
+
+__all__ = ["SPACES", "space_geometry", "TransformIndex"]
+
+
+# geometry of the volume spaces: voxel size (mm) and, for the anat spaces,
+# which share one field-of-view, the matrix size (res x res x res)
+SPACES = {
+    'anat0pt5': {'voxelsize': 0.5, 'res': 512},
+    'anat0pt8': {'voxelsize': 0.8, 'res': 320},
+    'anat1pt0': {'voxelsize': 1.0, 'res': 256},
+    'func1pt0': {'voxelsize': 1.0, 'res': None},
+    'func1pt8': {'voxelsize': 1.8, 'res': None},
+    'MNI': {'voxelsize': 1, 'res': None},
+}
+
+
+def space_geometry(space):
+    """voxel size and matrix size of a space
+
+    Args:
+        space (str or list): a space name (see NSDmapdata.fit).
+
+    Returns:
+        voxelsize (float): the voxel size in mm (None for surfaces).
+        res (int): the matrix size of the anat spaces (None otherwise).
+    """
+    if isinstance(space, str) and space in SPACES:
+        return SPACES[space]['voxelsize'], SPACES[space]['res']
+
+    return None, None
+
+
+def _parse_name(name):
+    """(sourcespace, targetspace) of a transform file name, or None"""
+    for ext in ('.nii.gz', '.mgz'):
+        if name.endswith(ext):
+            stem = name[:-len(ext)]
+            break
+    else:
+        return None
+
+    hemi = ''
+    if stem[:3] in ('lh.', 'rh.'):
+        hemi, stem = stem[:3], stem[3:]
+    if '-to-' not in stem:
+        return None
+    sourcespace, targetspace = stem.split('-to-', 1)
+
+    # the native surfaces carry the hemisphere
+    if hemi:
+        if sourcespace not in SPACES and sourcespace != 'fsaverage':
+            sourcespace = hemi + sourcespace
+        if targetspace not in SPACES and targetspace != 'fsaverage':
+            targetspace = hemi + targetspace
+
+    return sourcespace, targetspace
+
+
+class TransformIndex():
+    """index of the transforms of one subject, built from one directory scan
+
+    The file names of every transform are listed once, without opening
+    any file, so that jobs can be validated up front. The header (shape and
+    dtype) of a transform is only read when it is first asked for, and is
+    then kept, so that the cost of jobs can be estimated without loading
+    any data. Transforms added to the directory afterwards are not seen.
+
+    Attributes:
+        tdir (path): the subject's transforms directory.
+        entries (dict): file name -> {'pair': (sourcespace, targetspace)},
+                        plus 'shape' (tuple) and 'dtype' once the header
+                        has been read.
+    """
+
+    def __init__(self, tdir):
+        """list the transforms in <tdir>
+
+        Args:
+            tdir (path): the subject's transforms directory. If it does not
+                    exist, the index is empty.
+        """
+        self.tdir = tdir
+        self.entries = {}
+        if not os.path.isdir(tdir):
+            return
+
+        for entry in os.scandir(tdir):
+            pair = _parse_name(entry.name)
+            if pair is not None:
+                self.entries[entry.name] = {'pair': pair}
+
+    @classmethod
+    def for_subject(cls, base_dir, subjix):
+        """the index of subject <subjix> (1-8) of the nsd_data in base_dir"""
+        return cls(os.path.join(
+            nsd_datalocation(base_dir), 'ppdata',
+            f'subj{subjix:02d}', 'transforms'))
+
+    @property
+    def pairs(self):
+        """the set of (sourcespace, targetspace) with a transform file"""
+        return {entry['pair'] for entry in self.entries.values()}
+
+    def header(self, tfile):
+        """shape and dtype of a transform file (read on first use)
+
+        Raises:
+            FileNotFoundError: if the file is not in the transforms
+                    directory.
+        """
+        name = os.path.basename(tfile)
+        if name not in self.entries:
+            raise FileNotFoundError(
+                f'there is no transform {name} in {self.tdir}.')
+
+        entry = self.entries[name]
+        if 'shape' not in entry:
+            import nibabel as nib
+
+            img = nib.load(os.path.join(self.tdir, name))
+            entry['shape'] = tuple(int(n) for n in img.shape)
+            entry['dtype'] = img.get_data_dtype()
+
+        return entry['shape'], entry['dtype']
+
+    def check(self, tfile):
+        """raise FileNotFoundError unless every transform file exists"""
+        for c_file in (tfile if isinstance(tfile, list) else [tfile]):
+            if c_file is not None and \
+                    os.path.basename(c_file) not in self.entries:
+                raise FileNotFoundError(
+                    f'there is no transform {os.path.basename(c_file)} in '
+                    f'{self.tdir}.')
+
+    def space_shape(self, space):
+        """the shape of a space: X x Y x Z for volumes, (V,) for surfaces
+
+        The anat spaces are known up front; the other shapes differ between
+        subjects, and are read from the header of a transform that targets
+        <space> (from a volume, for volume spaces, since the transforms
+        from a surface only list the coordinates of its vertices).
+
+        Raises:
+            KeyError: if no transform tells the shape of <space>.
+        """
+        res = space_geometry(space)[1]
+        if res is not None:
+            return (res, res, res)
+
+        for name, entry in self.entries.items():
+            sourcespace, targetspace = entry['pair']
+            if targetspace != space:
+                continue
+            if space in SPACES:
+                if sourcespace in SPACES:
+                    return tuple(self.header(name)[0][:3])
+            else:
+                return (self.header(name)[0][0],)
+
+        raise KeyError(f'no transform in {self.tdir} targets {space}.')
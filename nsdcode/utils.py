@@ -18,69 +18,78 @@ def isnotfinite(arr):
     return res
 
 
-def makeimagestack(m):
+def makeimagestack(m, slicestep=1, downsample=1):
     """
-    def makeimagestack(m)
+    def makeimagestack(m, slicestep, downsample)
 
     <m> is a 3D matrix.  if more than 3D, we reshape to be 3D.
     we automatically convert to double format for the purposes of this method.
     try to make as square as possible
     (e.g. for 16 images, we would use [4 4]).
     find the minimum possible to fit all the images in.
+    <slicestep> (optional) is to only show every <slicestep>th slice.
+    default: 1.
+    <downsample> (optional) is to only show every <downsample>th voxel
+    along the first two dimensions. default: 1.
+
+    the images are placed in column-major order (i.e. image p goes to row
+    p % rows, column p // rows of the montage), each followed by a border
+    (set to the maximum of <m>). the tiling is a single reshape and
+    transpose, and <slicestep> and <downsample> are applied before
+    anything is copied, which makes quick previews of large volumes cheap.
     """
 
     bordersize = 1
 
+    # reshape to 3D (and subsample before making any copy)
+    m = np.asanyarray(m)
+    if m.ndim == 2:
+        m = m[:, :, np.newaxis]
+    elif m.ndim > 3:
+        m = np.reshape(m, m.shape[:2] + (-1,), order='F')
+    m = m[::downsample, ::downsample, ::slicestep]
+
     # calc
     nrows, ncols, numim = m.shape
-    mx = np.nanmax(m.ravel())
+    mx = np.nanmax(m)
 
     # calculate csize
 
     rows = floor(np.sqrt(numim))
     cols = ceil(numim/rows)
-    csize = [rows, cols]
-
-    # calc
-    chunksize = csize[0]*csize[1]
 
     # total cols and rows for adding border to slices
     tnrows = nrows+bordersize
     tncols = ncols+bordersize
 
-    # make a zero array of chunksize
-    # add border
-    mchunk = np.zeros((tnrows, tncols, chunksize))
-    mchunk[:, :, :numim] = mx
-    mchunk[:-1, :-1, :numim] = m
-
-    # combine images
-
-    flatmap = np.zeros((tnrows*rows, tncols*cols))
-    ci = 0
-    ri = 0
-    for plane in range(chunksize):
-        flatmap[ri:ri+tnrows, ci:ci+tncols] = mchunk[:, :, plane]
-        ri += tnrows
-        # if we have filled rows rows, change column
-        # and reset r
-        if plane != 0 and ri == tnrows*rows:
-            ci += tncols
-            ri = 0
+    # planes of the montage, with a border on the images
+    mchunk = np.zeros((cols*rows, tnrows, tncols))
+    mchunk[:numim] = mx
+    mchunk[:numim, :-1, :-1] = np.moveaxis(m, 2, 0)
+
+    # combine images (column x row x tnrows x tncols -> montage)
+    flatmap = mchunk.reshape(cols, rows, tnrows, tncols).transpose(
+        1, 2, 0, 3).reshape(rows*tnrows, cols*tncols)
 
     return flatmap
 
 
-def zerodiv(data1, data2, val=0, wantcaution=1):
-    """zerodiv(data1,data2,val,wantcaution)
+def zerodiv(data1, data2, val=0, wantcaution=1, out=None):
+    """zerodiv(data1,data2,val,wantcaution,out)
     Args:
         <data1>,<data2> are matrices of the same size or either
-                        or both can be scalars.
+                        or both can be scalars. more generally, they
+                        can be any two arrays that broadcast against
+                        each other (e.g. a n_datasets x voxels matrix
+                        and a vector of voxels weights).
         <val> (optional) is the value to use when <data2> is 0.
                         default: 0.
         <wantcaution> (optional) is whether to perform special
                         handling of weird cases (see below).
                         default: 1.
+        <out> (optional) is an array to write the result into
+                        (it can be <data1> itself, to divide in place).
+                        default: None, which allocates the result.
         calculate data1./data2 but use <val> when data2 is 0.
         if <wantcaution>, then if the absolute value of one or
                         more elements of data2 is less than 1e-5
@@ -92,38 +101,32 @@ def zerodiv(data1, data2, val=0, wantcaution=1):
     note some weird cases:
     if either data1 or data2 is [], we return [].
     NaNs in data1 and data2 are handled in the usual way.
+    the inputs are never modified (unless one of them is <out>).
 
     """
+    data2 = np.asarray(data2)
 
-    # handle special case of data2 being scalar
-    if np.isscalar(data2):
-        if data2 == 0:
-            f = np.tile(val, data1.shape)
-        else:
-            if wantcaution and abs(data2) < 1e-5:
+    # find the divisors to treat as 0 (only as large as data2)
+    if wantcaution:
+        bad = np.abs(data2) < 1e-5
+        if np.any(np.logical_and(bad, data2 != 0)):
+            if data2.ndim == 0:
                 print(
                     'warning: abs value of divisor is less than 1e-5.'
                     'treating the divisor as 0.')
-                f = np.tile(val, data1.shape)
             else:
-                f = data1/data2
-
+                print(
+                    'warning: abs value of one or more divisors'
+                    'less than 1e-5.treating them as 0.')
     else:
-        # do it
         bad = data2 == 0
-        bad2 = abs(data2) < 1e-5
-        if wantcaution and np.any(np.logical_and(bad2.ravel(), np.logical_not(bad.ravel()))):
-            print(
-                'warning: abs value of one or more divisors'
-                'less than 1e-5.treating them as 0.')
-
-        if wantcaution:
-            data2[bad2] = 1
-            f = data1/data2
-            f[bad2] = val
-        else:
-            data2[bad] = 1
-            f = data1/data2
-            f[bad] = val
+
+    # do it (the bad elements are filled in afterwards)
+    f = np.asarray(
+        np.divide(data1, data2, out=out, where=np.logical_not(bad)))
+    np.copyto(f, val, where=bad)
+
+    if out is None and f.ndim == 0:
+        f = f[()]
 
     return f
@@ -0,0 +1,56 @@
+"""tests of CompactField on small synthetic transforms
+"""
+import numpy as np
+import pytest
+from nsdcode.compact_field import CompactField
+
+
+def _field(rng, shape=(6, 7, 8), maxcoord=300):
+    """random case-1 field with a few 9999 holes"""
+    field = rng.uniform(1, maxcoord, shape + (3,))
+    field[1, 2, 3] = 9999
+    field[4, 0, 7] = 9999
+    return field
+
+
+@pytest.mark.parametrize('dtype, maxerr', [
+    (np.int16, None),
+    (np.int32, 1e-6)])
+def test_decode_error_is_within_half_a_step(dtype, maxerr):
+    rng = np.random.default_rng(0)
+    field = _field(rng)
+
+    compact = CompactField.encode(field, dtype=dtype, blocksize=3)
+
+    assert compact.data.dtype == dtype
+    assert np.log2(compact.scale) == np.round(np.log2(compact.scale))
+    decoded = compact.decode()
+    holes = field == 9999
+    np.testing.assert_array_equal(decoded == 9999, holes)
+    error = np.max(np.abs(decoded[~holes] - field[~holes]))
+    assert error <= compact.scale/2
+    if maxerr is not None:
+        assert error < maxerr
+
+
+def test_coords_match_the_field():
+    rng = np.random.default_rng(1)
+    field = _field(rng)
+    compact = CompactField.encode(field)
+
+    coords = compact.coords(blocksize=3)
+
+    expected = field.reshape((-1, 3), order='F').T - 1
+    bad = np.any(expected == 9998, axis=0)
+    assert coords.shape == expected.shape
+    assert np.all(np.isnan(coords[:, bad]))
+    assert np.all(
+        np.abs(coords[:, ~bad] - expected[:, ~bad]) <= compact.scale/2)
+
+
+def test_non_finite_fields_are_rejected():
+    field = np.ones((2, 2, 2, 3))
+    field[0, 0, 0, 0] = np.inf
+
+    with pytest.raises(ValueError):
+        CompactField.encode(field)
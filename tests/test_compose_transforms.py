@@ -0,0 +1,83 @@
+"""tests of compose_transforms on small synthetic transforms
+"""
+import numpy as np
+import pytest
+from nsdcode.compose_transforms import compose_transforms
+from nsdcode.transform_data import transform_data
+
+
+def _shift_field(shape, shift):
+    """case-1 field that maps every target voxel to source voxel + shift"""
+    grid = np.meshgrid(
+        *[np.arange(1, n + 1, dtype=np.float64) for n in shape],
+        indexing='ij')
+    return np.stack(grid, axis=-1) + shift
+
+
+def test_volume_hops_compose_into_one_field():
+    # A (10^3) -> B (8^3) -> C (6^3), all coordinates well inside
+    field_ab = _shift_field((8, 8, 8), 1.5)
+    field_bc = _shift_field((6, 6, 6), 1.25)
+
+    casenum, composite = compose_transforms([(1, field_ab), (1, field_bc)])
+
+    assert casenum == 1
+    np.testing.assert_allclose(
+        composite, _shift_field((6, 6, 6), 2.75), rtol=0, atol=1e-12)
+
+
+def test_composite_matches_two_mappings():
+    field_ab = _shift_field((8, 8, 8), 1.5)
+    field_bc = _shift_field((6, 6, 6), 1.25)
+    tr_args = {
+        'casenum': 1, 'interptype': 'linear', 'targetspace': 'func1pt0',
+        'voxelsize': 1.0, 'res': None, 'outputfile': None,
+        'outputclass': np.float64, 'badval': 0, 'fsdir': None}
+
+    # (linear data, so that resampling twice loses nothing)
+    x, y, z = np.meshgrid(*[np.arange(10.)] * 3, indexing='ij')
+    sourcedata = x - 2*y + 3*z
+    twice = transform_data(
+        field_bc, transform_data(field_ab, sourcedata, tr_args), tr_args)
+    _, composite = compose_transforms([(1, field_ab), (1, field_bc)])
+    once = transform_data(composite, sourcedata, tr_args)
+
+    np.testing.assert_allclose(once, twice, rtol=0, atol=1e-10)
+
+
+def test_holes_propagate():
+    field_ab = _shift_field((8, 8, 8), 1.5)
+    field_ab[4, 4, 4] = 9999
+    field_bc = _shift_field((6, 6, 6), 1.25)
+
+    _, composite = compose_transforms([(1, field_ab), (1, field_bc)])
+
+    # C voxel c (0-based) lands at B voxel c + 1.25, so C voxels 2 and 3
+    # draw on the hole at B voxel 4 along every axis
+    holes = np.zeros((6, 6, 6), dtype=bool)
+    holes[2:4, 2:4, 2:4] = True
+    np.testing.assert_array_equal(np.all(composite == 9999, axis=3), holes)
+    assert np.all(composite[~holes] != 9999)
+
+
+def test_surface_hops_compose():
+    # A (10^3) -> B (8^3) -> surface (4 vertices) -> fsaverage (3)
+    field_ab = _shift_field((8, 8, 8), 1.5)
+    vertices = np.array(
+        [[2, 3, 4], [5, 5, 5], [7.5, 2.25, 3], [4, 4, 6]], dtype=np.float64)
+    indices = np.array([[2], [4], [1]], dtype=np.float64)
+
+    casenum, composite = compose_transforms(
+        [(1, field_ab), (2, vertices), (3, indices)])
+
+    assert casenum == 2
+    np.testing.assert_allclose(
+        composite, vertices[[1, 3, 0]] + 1.5, rtol=0, atol=1e-12)
+
+
+def test_surface_to_volume_cannot_be_composed():
+    field_ab = _shift_field((8, 8, 8), 1.5)
+    vertices = np.ones((4, 3))
+
+    with pytest.raises(ValueError):
+        compose_transforms([(2, vertices), (1, field_ab)])
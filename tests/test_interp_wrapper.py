@@ -0,0 +1,105 @@
+"""tests of interp_prepare and interp_wrapper
+"""
+import numpy as np
+import pytest
+from nsdcode.interp_wrapper import interp_prepare, interp_wrapper
+
+
+def _coords(rng, volshape, n_points=500):
+    """random 0-based coordinates, some of them NaN or out of range"""
+    coords = rng.uniform(-1, np.max(volshape[:3]) + 1, (3, n_points))
+    coords[:, :5] = np.nan
+    return coords
+
+
+@pytest.mark.parametrize('interptype', ['nearest', 'linear', 'cubic'])
+def test_plan_matches_direct_call(interptype):
+    rng = np.random.default_rng(0)
+    vol = rng.standard_normal((10, 11, 12))
+    coords = _coords(rng, vol.shape)
+
+    direct = interp_wrapper(vol, coords.copy(), interptype=interptype)
+    plan = interp_prepare(coords, vol.shape)
+    planned = interp_wrapper(vol, None, interptype=interptype, plan=plan)
+
+    np.testing.assert_array_equal(planned, direct)
+    assert np.all(np.isnan(planned[plan['bad']]))
+
+
+def test_plan_is_reused_read_only():
+    rng = np.random.default_rng(1)
+    vols = rng.standard_normal((10, 11, 12, 4))
+    coords = _coords(rng, vols.shape)
+    original = coords.copy()
+
+    plan = interp_prepare(coords, vols.shape)
+    for key in ('coords', 'bad'):
+        plan[key].flags.writeable = False
+
+    # every volume sees the same bad locations (the plan is not modified)
+    for vol_i in range(vols.shape[3]):
+        planned = interp_wrapper(
+            vols[..., vol_i], None, interptype='cubic', plan=plan)
+        direct = interp_wrapper(
+            vols[..., vol_i], original.copy(), interptype='cubic')
+        np.testing.assert_array_equal(planned, direct)
+
+    np.testing.assert_array_equal(coords, original)
+
+
+def test_sorted_plan_gives_the_same_results():
+    rng = np.random.default_rng(2)
+    vol = rng.standard_normal((10, 11, 12))
+    coords = _coords(rng, vol.shape)
+
+    unsorted = interp_wrapper(
+        vol, None, interptype='cubic',
+        plan=interp_prepare(coords, vol.shape, sort=False))
+    plan = interp_prepare(coords, vol.shape, sort=True)
+    assert plan['order'] is not None
+
+    np.testing.assert_array_equal(
+        interp_wrapper(vol, None, interptype='cubic', plan=plan), unsorted)
+
+
+def test_cubicconv_is_exact_for_linear_fields():
+    x, y, z = np.meshgrid(
+        np.arange(10.), np.arange(11.), np.arange(12.), indexing='ij')
+    vol = 2*x - 3*y + 0.5*z + 1
+
+    # (the 4 x 4 x 4 taps of these locations are all inside the volume)
+    rng = np.random.default_rng(3)
+    coords = rng.uniform(1, 8, (3, 500))
+    plan = interp_prepare(coords, vol.shape, interptype='cubicconv')
+    transformeddata = interp_wrapper(
+        vol, None, interptype='cubicconv', plan=plan)
+
+    expected = 2*coords[0] - 3*coords[1] + 0.5*coords[2] + 1
+    np.testing.assert_allclose(transformeddata, expected, rtol=0, atol=1e-5)
+
+
+def test_cubicconv_stack_matches_single_volumes():
+    rng = np.random.default_rng(4)
+    vols = rng.standard_normal((10, 11, 12, 3))
+    coords = _coords(rng, vols.shape)
+    plan = interp_prepare(coords, vols.shape, interptype='cubicconv')
+
+    stack = interp_wrapper(vols, None, interptype='cubicconv', plan=plan)
+    assert stack.shape == (coords.shape[1], 3)
+    for vol_i in range(3):
+        np.testing.assert_allclose(
+            stack[:, vol_i],
+            interp_wrapper(
+                vols[..., vol_i], coords.copy(), interptype='cubicconv'),
+            rtol=0, atol=1e-12)
+
+
+def test_cubicconv_interpolates_through_the_voxels():
+    rng = np.random.default_rng(5)
+    vol = rng.standard_normal((10, 11, 12))
+    coords = np.array([[3, 4, 5], [7, 2, 9], [1, 1, 1]], dtype=np.float64).T
+
+    transformeddata = interp_wrapper(vol, coords.copy(), 'cubicconv')
+
+    np.testing.assert_allclose(
+        transformeddata, vol[tuple(coords.astype(int))], rtol=0, atol=1e-6)
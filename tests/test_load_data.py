@@ -0,0 +1,67 @@
+"""tests of reading (selected volumes of) source data
+"""
+import nibabel as nib
+import numpy as np
+import pytest
+from nsdcode.load_data import _read_volumes, load_sourcedata
+
+
+def _nifti(tmp_path, data, name='source.nii.gz'):
+    """write <data> to a nifti file and return its name"""
+    filename = str(tmp_path / name)
+    nib.Nifti1Image(data, np.eye(4)).to_filename(filename)
+    return filename
+
+
+@pytest.mark.parametrize('volumes', [
+    [0, 1, 2, 5, 6],
+    [6, 2, 3],
+    slice(1, 5, 2),
+    3,
+    np.array([True, False, False, True, True, False, True])])
+def test_read_volumes_matches_indexing(volumes):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((3, 4, 5, 7))
+
+    selected = _read_volumes(data, volumes)
+
+    expected = data[..., np.atleast_1d(np.arange(7)[volumes])]
+    np.testing.assert_array_equal(selected, expected)
+    assert selected.flags.f_contiguous
+
+
+def test_read_volumes_needs_several_datasets():
+    with pytest.raises(ValueError):
+        _read_volumes(np.zeros((3, 4, 5)), [0])
+
+
+def test_load_only_selected_volumes(tmp_path):
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((3, 4, 5, 6)).astype(np.float32)
+    filename = _nifti(tmp_path, data)
+
+    sourcedata = load_sourcedata(1, filename, volumes=[4, 1, 2])
+
+    assert sourcedata.dtype == np.float64
+    np.testing.assert_array_equal(sourcedata, data[..., [4, 1, 2]])
+
+
+def test_lazy_load_returns_a_proxy(tmp_path):
+    rng = np.random.default_rng(2)
+    data = rng.standard_normal((3, 4, 5, 6))
+    filename = _nifti(tmp_path, data)
+
+    proxy = load_sourcedata(1, filename, lazy=True)
+
+    assert not isinstance(proxy, np.ndarray)
+    assert proxy.shape == data.shape
+    np.testing.assert_array_equal(proxy[..., 2:4], data[..., 2:4])
+
+
+def test_list_of_vectors_is_stacked():
+    # (one vector per hemisphere, e.g. a case-4 source)
+    lh, rh = np.arange(5.), np.arange(5., 8.)
+
+    sourcedata = load_sourcedata(4, [lh, rh])
+
+    np.testing.assert_array_equal(sourcedata, np.arange(8.)[:, np.newaxis])
@@ -0,0 +1,80 @@
+"""tests of MappedArray (the lazy result of transform_data)
+"""
+import numpy as np
+import pytest
+from nsdcode.mapped_array import MappedArray
+from nsdcode.transform_data import transform_data
+
+
+def _mapping(n_vols=4):
+    """the lazy and the computed mapping of a random source stack"""
+    rng = np.random.default_rng(0)
+    sourcedata = rng.standard_normal((8, 9, 10, n_vols))
+    grid = np.meshgrid(
+        *[np.arange(1, n + 1, dtype=np.float64) for n in (6, 7, 8)],
+        indexing='ij')
+    field = np.stack(grid, axis=-1) + 1.3
+    field[2, 3, 4] = 9999
+    tr_args = {
+        'casenum': 1, 'interptype': 'cubic', 'targetspace': 'func1pt0',
+        'voxelsize': 1.0, 'res': None, 'outputfile': None,
+        'outputclass': np.float32, 'badval': -1, 'fsdir': None}
+
+    full = transform_data(field, sourcedata, tr_args)
+    lazy = transform_data(field, sourcedata, dict(tr_args, lazy=True))
+    return lazy, full
+
+
+def test_lazy_matches_computed():
+    lazy, full = _mapping()
+
+    assert isinstance(lazy, MappedArray)
+    assert lazy.shape == full.shape
+    assert lazy.dtype == full.dtype
+    np.testing.assert_array_equal(np.asarray(lazy), full)
+
+
+@pytest.mark.parametrize('key', [
+    2,
+    -1,
+    (..., 1),
+    (slice(None), 3, ..., slice(1, 3)),
+    (0, 1, 2),
+    (..., np.array([True, False, True, False])),
+    (slice(1, 4), slice(None), 5, slice(4, 4)),
+    Ellipsis])
+def test_indexing_follows_numpy(key):
+    lazy, full = _mapping()
+
+    np.testing.assert_array_equal(lazy[key], full[key])
+
+
+def test_volumes_are_stacked_last():
+    # (numpy would move the axis of the list first here, since the integer
+    # and the list are separated by slices)
+    lazy, full = _mapping()
+
+    np.testing.assert_array_equal(
+        lazy[1, ..., [3, 0]],
+        np.stack([full[1, ..., 3], full[1, ..., 0]], axis=-1))
+
+
+def test_results_are_copies_of_the_cache():
+    lazy, full = _mapping()
+
+    vol = lazy[..., 0]
+    vol[...] = 0
+
+    np.testing.assert_array_equal(lazy[..., 0], full[..., 0])
+
+
+@pytest.mark.parametrize('key', [
+    (None, 0),
+    (..., 0, ...),
+    (0, 0, 0, 0, 0),
+    np.ones((6, 7), dtype=bool)])
+def test_unsupported_keys_raise(key):
+    lazy, _ = _mapping()
+
+    with pytest.raises(IndexError):
+        lazy[key]
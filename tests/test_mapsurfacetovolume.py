@@ -0,0 +1,95 @@
+"""tests of mapsurfacetovolume on small synthetic surfaces
+"""
+import nibabel as nib
+import numpy as np
+import pytest
+from nsdcode.mapsurfacetovolume import mapsurfacetovolume
+from nsdcode.transform_data import transform_data
+
+
+def _surface(rng, res, n_vertices=200):
+    """random 1-based vertex coordinates well inside a res^3 volume"""
+    return rng.uniform(2, res - 1, (3, n_vertices))
+
+
+def test_blocked_matches_unblocked():
+    rng = np.random.default_rng(0)
+    vertices = _surface(rng, 8)
+    data = rng.standard_normal((5, vertices.shape[1]))
+
+    whole = mapsurfacetovolume(data, vertices, 8, False, np.nan)
+    # (a budget of one byte maps one dataset at a time)
+    blocked = mapsurfacetovolume(
+        data, vertices, 8, False, np.nan, max_bytes=1)
+
+    assert whole.shape == (8, 8, 8, 5)
+    np.testing.assert_array_equal(blocked, whole)
+
+
+def test_vertices_on_voxels_are_averaged():
+    # vertices that sit exactly on a voxel give it all their weight
+    vertices = np.array([[2, 3, 4], [2, 3, 4], [5, 5, 1]], dtype=float).T
+    data = np.array([[1., 3., -2.], [0., 10., 7.]])
+
+    targetdata = mapsurfacetovolume(data, vertices, 6, False, -99)
+
+    np.testing.assert_array_equal(targetdata[1, 2, 3], [2., 5.])
+    np.testing.assert_array_equal(targetdata[4, 4, 0], [-2., 7.])
+    n_filled = np.sum(np.all(targetdata != -99, axis=3))
+    assert n_filled == 2
+
+
+def test_writes_into_out():
+    rng = np.random.default_rng(1)
+    vertices = _surface(rng, 8)
+    data = rng.standard_normal((3, vertices.shape[1]))
+    expected = mapsurfacetovolume(data, vertices, 8, False, 0)
+
+    out = np.full((8, 8, 8, 3), np.nan, order='F')
+    targetdata = mapsurfacetovolume(
+        data, vertices, 8, False, 0, out=out, max_bytes=1)
+
+    assert targetdata is out
+    np.testing.assert_array_equal(out, expected)
+
+    with pytest.raises(ValueError):
+        mapsurfacetovolume(
+            data, vertices, 8, False, 0, out=np.zeros((8, 8, 8, 3)))
+
+
+def test_winner_take_all_labels():
+    vertices = np.array(
+        [[2, 3, 4], [2, 3, 4], [2, 3, 4], [5, 5, 1]], dtype=float).T
+    data = np.array([[3, 3, 7, 7]])
+
+    targetdata = mapsurfacetovolume(data, vertices, 6, True, 0)
+
+    assert targetdata.dtype.kind == 'i'
+    assert targetdata[1, 2, 3, 0] == 3
+    assert targetdata[4, 4, 0, 0] == 7
+    assert np.sum(targetdata != 0) == 2
+
+
+def test_transform_data_case4_layout(tmp_path):
+    rng = np.random.default_rng(2)
+    vertices = _surface(rng, 8)
+    data = rng.standard_normal((vertices.shape[1], 3))
+    tr_args = {
+        'casenum': 4, 'interptype': 'surfacelinear', 'targetspace': 'anat',
+        'voxelsize': 1.0, 'res': 8, 'outputfile': None,
+        'outputclass': np.float64, 'badval': 0, 'fsdir': None}
+    expected = mapsurfacetovolume(data.T, vertices, 8, False, 0)
+
+    # V x D gives res^3 x D, and V (or V x 1) gives res^3
+    np.testing.assert_array_equal(
+        transform_data(vertices.T, data, tr_args), expected)
+    for sourcedata in (data[:, 0], data[:, :1]):
+        np.testing.assert_array_equal(
+            transform_data(vertices.T, sourcedata, tr_args),
+            expected[..., 0])
+
+    # with a sink, the volumes are written straight into the output file
+    outputfile = str(tmp_path / 'sink.nii')
+    tr_args.update(sink=True, outputfile=outputfile)
+    transform_data(vertices.T, data, tr_args)
+    np.testing.assert_array_equal(nib.load(outputfile).get_fdata(), expected)
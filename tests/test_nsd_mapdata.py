@@ -0,0 +1,36 @@
+"""tests of the helpers of NSDmapdata
+"""
+import numpy as np
+import pytest
+from nsdcode.nsd_mapdata import _mask_indices
+
+
+def test_boolean_masks_are_read_in_fortran_order():
+    mask = np.zeros((3, 4, 5), dtype=bool)
+    mask[1, 2, 3] = True
+    mask[2, 0, 0] = True
+
+    indices = _mask_indices(mask, (3, 4, 5))
+
+    np.testing.assert_array_equal(
+        indices, np.sort(np.ravel_multi_index(
+            ([1, 2], [2, 0], [3, 0]), (3, 4, 5), order='F')))
+
+
+def test_index_masks_are_kept():
+    np.testing.assert_array_equal(
+        _mask_indices([4, 0, 59], (3, 4, 5)), [4, 0, 59])
+    np.testing.assert_array_equal(
+        _mask_indices(np.array([[1], [2]], dtype=np.int16), (10,)), [1, 2])
+    assert _mask_indices([], (3, 4, 5)).size == 0
+
+
+@pytest.mark.parametrize('mask', [
+    np.zeros((3, 4, 4), dtype=bool),
+    [0, 60],
+    [-1, 2],
+    [0.5, 2.0],
+    np.array([1.0, 2.0])])
+def test_invalid_masks_are_rejected(mask):
+    with pytest.raises(ValueError):
+        _mask_indices(mask, (3, 4, 5))
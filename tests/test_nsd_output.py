@@ -0,0 +1,138 @@
+"""tests of the volume and surface writers in nsd_output
+"""
+import os
+import nibabel as nib
+import numpy as np
+import pytest
+from nsdcode.nsd_output import _quantize, nsd_write_fs, nsd_write_vol
+
+
+def _fsdir(tmp_path, n_vertices=20):
+    """a subject directory with the template surface files nsd_write_fs
+    reads"""
+    fsdir = tmp_path / 'fs'
+    (fsdir / 'surf').mkdir(parents=True)
+    for hemi in ('lh', 'rh'):
+        nib.MGHImage(
+            np.zeros((n_vertices, 1, 1), dtype=np.float32), np.eye(4)
+            ).to_filename(str(fsdir / 'surf' / f'{hemi}.w-g.pct.mgh'))
+    return str(fsdir)
+
+
+def test_quantize_error_is_within_half_a_step():
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-3, 40, (5, 6, 7))
+
+    raw, slope, inter = _quantize(data)
+
+    assert raw.dtype == np.int16
+    assert inter == 0
+    assert np.all(np.abs(raw*slope + inter - data) <= slope/2)
+
+
+def test_quantize_keeps_zero_exact_and_zeroes_nan():
+    data = np.array([0., -1.5, 2.25, np.nan, np.inf, 0.])
+
+    raw, slope, inter = _quantize(data)
+
+    np.testing.assert_array_equal(raw[[0, 3, 4, 5]], 0)
+    assert np.all(np.abs(raw[1:3]*slope + inter - data[1:3]) <= slope/2)
+
+
+def test_quantize_positive_range_uses_an_offset():
+    data = np.linspace(1000, 1001, 50)
+
+    raw, slope, inter = _quantize(data)
+
+    assert inter != 0
+    assert slope < 1e-3
+    assert np.all(np.abs(raw*slope + inter - data) <= slope/2)
+
+
+def test_quantize_clips_to_a_given_scaling():
+    data = np.array([-10., 0., 1., 10.])
+
+    raw, slope, inter = _quantize(data, scaling=(1e-4, 0.))
+
+    assert (slope, inter) == (1e-4, 0.)
+    np.testing.assert_array_equal(raw, [-32768, 0, 10000, 32767])
+
+
+def test_write_vol_int16_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((5, 6, 7, 2))
+    data[0, 0, 0] = 0
+    outputfile = str(tmp_path / 'vol.nii.gz')
+
+    nsd_write_vol(data, 1.8, outputfile, quantize='int16')
+
+    img = nib.load(outputfile)
+    assert img.get_data_dtype() == np.int16
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    written = img.get_fdata()
+    assert written.shape == data.shape
+    assert np.all(np.abs(written - data) <= slope/2 + 1e-12)
+    np.testing.assert_array_equal(written[0, 0, 0], 0)
+    np.testing.assert_allclose(np.diag(img.affine), [1.8, 1.8, 1.8, 1])
+
+    # a given scaling is stored as is
+    nsd_write_vol(data, 1.8, outputfile, quantize=(slope, inter))
+    img = nib.load(outputfile)
+    assert (img.dataobj.slope, img.dataobj.inter) == (slope, inter)
+    np.testing.assert_array_equal(img.get_fdata(), written)
+
+
+@pytest.mark.parametrize('shape, written', [
+    ((20,), (20, 1, 1)),
+    ((20, 1), (20, 1, 1)),
+    ((20, 3), (20, 1, 1, 3))])
+def test_write_fs_shapes(tmp_path, shape, written):
+    rng = np.random.default_rng(2)
+    data = rng.standard_normal(shape).astype(np.float32)
+    outputfile = str(tmp_path / 'lh.data.mgz')
+
+    nsd_write_fs(data, outputfile, _fsdir(tmp_path))
+
+    img = nib.load(outputfile)
+    assert img.shape == written
+    np.testing.assert_array_equal(
+        np.asarray(img.dataobj).reshape(shape), data)
+
+
+@pytest.mark.parametrize('dtype, stored', [
+    (np.bool_, np.uint8),
+    (np.uint8, np.uint8),
+    (np.int16, np.int16),
+    (np.int64, np.int32),
+    (np.float64, np.float32)])
+def test_write_fs_dtypes(tmp_path, dtype, stored):
+    data = (np.arange(20) % 2).astype(dtype)
+    outputfile = str(tmp_path / 'rh.data.mgh')
+
+    nsd_write_fs(data, outputfile, _fsdir(tmp_path))
+
+    img = nib.load(outputfile)
+    # (MGH files are big-endian)
+    assert img.get_data_dtype().newbyteorder('=') == stored
+    np.testing.assert_array_equal(np.asarray(img.dataobj)[:, 0, 0], data)
+
+
+def test_write_fs_compresslevel(tmp_path):
+    fsdir = _fsdir(tmp_path, n_vertices=5000)
+    data = np.tile(np.arange(100, dtype=np.float32), 50)
+    fast = str(tmp_path / 'lh.fast.mgz')
+    small = str(tmp_path / 'lh.small.mgz')
+
+    nsd_write_fs(data, fast, fsdir, compresslevel=1)
+    nsd_write_fs(data, small, fsdir, compresslevel=9)
+
+    for outputfile in (fast, small):
+        np.testing.assert_array_equal(
+            np.asarray(nib.load(outputfile).dataobj)[:, 0, 0], data)
+    assert os.path.getsize(small) <= os.path.getsize(fast)
+
+
+def test_write_fs_needs_a_hemisphere(tmp_path):
+    with pytest.raises(ValueError):
+        nsd_write_fs(
+            np.zeros(20), str(tmp_path / 'data.mgz'), _fsdir(tmp_path))
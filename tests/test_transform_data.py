@@ -0,0 +1,80 @@
+"""tests of transform_data on small synthetic transforms
+"""
+import numpy as np
+import pytest
+from nsdcode.transform_data import transform_data
+
+
+def _tr_args(**kwargs):
+    """transform_data arguments for a volume-to-volume mapping"""
+    tr_args = {
+        'casenum': 1,
+        'interptype': 'linear',
+        'targetspace': 'func1pt0',
+        'voxelsize': 1.0,
+        'res': None,
+        'outputfile': None,
+        'outputclass': np.float64,
+        'badval': -1,
+        'fsdir': None}
+    tr_args.update(kwargs)
+    return tr_args
+
+
+def _shift_field(shape, shift):
+    """case-1 field that maps every target voxel to source voxel + shift"""
+    grid = np.meshgrid(
+        *[np.arange(1, n + 1, dtype=np.float64) for n in shape],
+        indexing='ij')
+    return np.stack(grid, axis=-1) + shift
+
+
+def test_holes_are_bad_in_every_volume():
+    rng = np.random.default_rng(0)
+    sourcedata = rng.standard_normal((8, 9, 10, 3))
+    field = _shift_field((6, 7, 8), 1)
+    field[2, 3, 4] = 9999
+    field[4, 1, 1, 0] = 9999
+
+    transformeddata = transform_data(field, sourcedata, _tr_args())
+
+    assert transformeddata.shape == (6, 7, 8, 3)
+    for vol_i in range(3):
+        assert np.all(transformeddata[2, 3, 4, vol_i] == -1)
+        assert np.all(transformeddata[4, 1, 1, vol_i] == -1)
+    np.testing.assert_allclose(
+        transformeddata[:2], sourcedata[1:3, 1:8, 1:9])
+
+
+def test_pool_matches_serial(tmp_path):
+    rng = np.random.default_rng(1)
+    sourcedata = rng.standard_normal((8, 9, 10, 5))
+    field = _shift_field((6, 7, 8), 1.3)
+
+    serial = transform_data(field, sourcedata, _tr_args())
+    pooled = transform_data(field, sourcedata, _tr_args(n_jobs=2))
+    np.testing.assert_array_equal(pooled, serial)
+
+    # with a sink, the workers write into the output file
+    outputfile = str(tmp_path / 'sink.npy')
+    sunk = transform_data(
+        field, sourcedata,
+        _tr_args(n_jobs=2, sink=True, outputfile=outputfile))
+    np.testing.assert_array_equal(np.load(outputfile), serial)
+    np.testing.assert_array_equal(sunk, serial)
+
+
+@pytest.mark.parametrize('interptype', ['linear', 'cubic', 'cubicconv'])
+def test_mask_matches_full_mapping(interptype):
+    rng = np.random.default_rng(2)
+    sourcedata = rng.standard_normal((8, 9, 10, 2))
+    field = _shift_field((6, 7, 8), 1.3)
+    mask = np.array([0, 5, 17, 100, 335])
+
+    full = transform_data(
+        field, sourcedata, _tr_args(interptype=interptype))
+    masked = transform_data(
+        field, sourcedata, _tr_args(interptype=interptype, mask=mask))
+
+    np.testing.assert_allclose(
+        masked, full.reshape((-1, 2), order='F')[mask], rtol=0, atol=1e-12)
@@ -0,0 +1,58 @@
+"""tests of TransformIndex on a synthetic transforms directory
+"""
+import nibabel as nib
+import numpy as np
+import pytest
+from nsdcode.transform_index import TransformIndex
+
+
+def _tdir(tmp_path):
+    """a transforms directory with volume and surface transforms"""
+    tdir = tmp_path / 'transforms'
+    tdir.mkdir()
+    for name, shape in (
+            ('func1pt8-to-anat0pt8.nii.gz', (4, 5, 6, 3)),
+            ('anat0pt8-to-func1pt8.nii.gz', (8, 9, 10, 3)),
+            ('lh.white-to-func1pt8.nii.gz', (7, 1, 1, 3)),
+            ('func1pt8-to-lh.white.nii.gz', (7, 1, 1, 3))):
+        nib.Nifti1Image(np.zeros(shape), np.eye(4)).to_filename(
+            str(tdir / name))
+    (tdir / 'notes.txt').write_text('not a transform')
+    return str(tdir)
+
+
+def test_names_are_parsed_without_reading_files(tmp_path):
+    index = TransformIndex(_tdir(tmp_path))
+
+    assert index.pairs == {
+        ('func1pt8', 'anat0pt8'), ('anat0pt8', 'func1pt8'),
+        ('lh.white', 'func1pt8'), ('func1pt8', 'lh.white')}
+    assert all('shape' not in entry for entry in index.entries.values())
+
+
+def test_headers_are_read_on_demand(tmp_path):
+    index = TransformIndex(_tdir(tmp_path))
+
+    shape, _ = index.header('func1pt8-to-anat0pt8.nii.gz')
+
+    assert shape == (4, 5, 6, 3)
+    assert 'shape' in index.entries['func1pt8-to-anat0pt8.nii.gz']
+    assert 'shape' not in index.entries['lh.white-to-func1pt8.nii.gz']
+
+    # (the surface-to-volume transform lists vertices, not the volume)
+    assert index.space_shape('func1pt8') == (8, 9, 10)
+    assert index.space_shape('lh.white') == (7,)
+    assert index.space_shape('anat0pt8') == (320, 320, 320)
+    with pytest.raises(KeyError):
+        index.space_shape('MNI')
+
+
+def test_missing_transforms_are_reported(tmp_path):
+    index = TransformIndex(_tdir(tmp_path))
+
+    index.check(['func1pt8-to-anat0pt8.nii.gz', None])
+    with pytest.raises(FileNotFoundError):
+        index.check('func1pt8-to-MNI.nii.gz')
+    with pytest.raises(FileNotFoundError):
+        index.header('func1pt8-to-MNI.nii.gz')
+    assert TransformIndex(str(tmp_path / 'missing')).entries == {}